@@ -1,13 +1,32 @@
 # file: azure_ocr.py
 """
 Azure Document Intelligence (Form Recognizer v3) helper for invoice OCR.
-Uses azure-ai-formrecognizer SDK.
+Uses azure-ai-formrecognizer SDK. The async client (aio) is used by the API so
+OCR calls don't block the event loop; the sync client serves scripts.
 """
+import asyncio
+import copy
+import functools
+import hashlib
+import io
+import logging
 import os
-from typing import Dict, Any, List, Optional
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, BinaryIO, List, Optional, Sequence, Tuple, Union
 
+import aiohttp
 from azure.ai.formrecognizer import DocumentAnalysisClient
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient as AsyncDocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+from azure.core.pipeline.transport import AioHttpTransport
+
+from metrics import OCR_CACHE_HITS, OCR_INFLIGHT, OCR_SECONDS
+
+logger = logging.getLogger(__name__)
 
 
 class AzureOCRError(Exception):
@@ -19,6 +38,61 @@ def _clean_env(value: Optional[str]) -> str:
     return (value or "").strip()
 
 
+# ========== OCR RESULT CACHE ==========
+# Identical PDF bytes always produce the same normalized result, so re-uploads
+# and retries are served from memory instead of another billable Azure call.
+_ocr_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_ocr_cache_lock = threading.Lock()
+
+
+def _cache_enabled() -> bool:
+    # Read lazily: callers load .env after importing this module.
+    return _clean_env(os.getenv("OCR_CACHE_ENABLED", "1")).lower() not in ("0", "false", "no", "off")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(_clean_env(os.getenv(name)) or default)
+    except ValueError:
+        return default
+
+
+def _cache_size() -> int:
+    return _env_int("OCR_CACHE_SIZE", 512)
+
+
+def document_hasher():
+    """Incremental hasher for the OCR cache key (BLAKE2b is the fastest digest in hashlib).
+    Feed it chunks while streaming an upload to avoid a second pass over the file."""
+    return hashlib.blake2b(digest_size=16)
+
+
+def document_hash(file_bytes: bytes) -> str:
+    hasher = document_hasher()
+    hasher.update(file_bytes)
+    return hasher.hexdigest()
+
+
+def _cache_get(key: str) -> Optional[Dict[str, Any]]:
+    with _ocr_cache_lock:
+        cached = _ocr_cache.get(key)
+        if cached is None:
+            return None
+        _ocr_cache.move_to_end(key)
+    OCR_CACHE_HITS.inc()
+    # Callers mutate the result (e.g. pop "raw"), so never hand out the cached dict
+    return copy.deepcopy(cached)
+
+
+def _cache_put(key: str, normalized: Dict[str, Any]) -> None:
+    stored = copy.deepcopy(normalized)
+    with _ocr_cache_lock:
+        _ocr_cache[key] = stored
+        _ocr_cache.move_to_end(key)
+        while len(_ocr_cache) > _cache_size():
+            _ocr_cache.popitem(last=False)
+
+
 def _normalize_endpoint(endpoint: str) -> str:
     endpoint = endpoint.strip()
     if not endpoint:
@@ -30,7 +104,109 @@ def _normalize_endpoint(endpoint: str) -> str:
     return endpoint
 
 
-def get_azure_client() -> DocumentAnalysisClient:
+# ========== CONCURRENCY + RETRY ==========
+# A burst of uploads must not exceed the Azure quota; throttled (429) and
+# transient 5xx/connection failures are retried with exponential backoff.
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# Failed long-running operations don't always carry a status code; fall back to the message
+TRANSIENT_MESSAGE_MARKERS = ("rate limit", "too many requests", "quota", "throttl", "timeout", "timed out")
+RETRY_MIN_DELAY = 1.0
+RETRY_MAX_DELAY = 16.0
+
+class RateLimiter:
+    """Spaces calls at least 1/rps seconds apart within one worker.
+    The slot is reserved under the lock; the wait itself happens outside it."""
+
+    def __init__(self, rps: float):
+        self._interval = 1.0 / rps if rps > 0 else 0.0
+        self._lock = asyncio.Lock()
+        self._next_slot = 0.0
+
+    async def wait(self) -> None:
+        if not self._interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self._interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+_ocr_semaphore: Optional[asyncio.Semaphore] = None
+_ocr_rate_limiter: Optional[RateLimiter] = None
+
+
+def _get_ocr_semaphore() -> asyncio.Semaphore:
+    global _ocr_semaphore
+    if _ocr_semaphore is None:
+        _ocr_semaphore = asyncio.Semaphore(_env_int("AZURE_OCR_CONCURRENCY", 4))
+    return _ocr_semaphore
+
+
+def _get_ocr_rate_limiter() -> RateLimiter:
+    global _ocr_rate_limiter
+    if _ocr_rate_limiter is None:
+        try:
+            rps = float(_clean_env(os.getenv("AZURE_OCR_RPS")) or 15)
+        except ValueError:
+            rps = 15.0
+        _ocr_rate_limiter = RateLimiter(rps)
+    return _ocr_rate_limiter
+
+
+def _is_transient(exc: Exception) -> bool:
+    if isinstance(exc, (ServiceRequestError, ServiceResponseError, asyncio.TimeoutError)):
+        return True
+    status_code = getattr(exc, "status_code", None)
+    if status_code is not None:
+        return status_code in TRANSIENT_STATUS_CODES
+    message = str(exc).lower()
+    return any(marker in message for marker in TRANSIENT_MESSAGE_MARKERS)
+
+
+def _retry_delay(exc: Exception, attempt: int) -> float:
+    """Honour Retry-After when Azure sends it, else exponential backoff with jitter,
+    doubling from RETRY_MIN_DELAY up to RETRY_MAX_DELAY."""
+    response = getattr(exc, "response", None)
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return min(max(float(retry_after), RETRY_MIN_DELAY), RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    backoff = min(RETRY_MAX_DELAY, RETRY_MIN_DELAY * 2 ** (attempt - 1))
+    return backoff * random.uniform(0.5, 1.0)
+
+
+class _OCRAttempts:
+    """Cache lookup, attempt bookkeeping and backoff shared by the sync and async
+    analyze paths, so both follow one retry policy. Only the Azure call and the
+    sleep differ between them."""
+
+    def __init__(self, content_hash: Optional[str]):
+        self.cache_key = content_hash if _cache_enabled() else None
+        self.cached = _cache_get(self.cache_key) if self.cache_key else None
+        self.max_attempts = max(1, _env_int("AZURE_OCR_MAX_ATTEMPTS", 3))
+
+    def __iter__(self):
+        return iter(range(1, self.max_attempts + 1))
+
+    def backoff(self, exc: Exception, attempt: int) -> float:
+        """Seconds to wait before retrying `exc`; raises AzureOCRError when it is final."""
+        if attempt >= self.max_attempts or not _is_transient(exc):
+            raise AzureOCRError(str(exc)) from exc
+        delay = _retry_delay(exc, attempt)
+        logger.warning(f"Transient OCR error (attempt {attempt}/{self.max_attempts}), retrying in {delay:.1f}s: {exc}")
+        return delay
+
+    def done(self, normalized: Dict[str, Any]) -> Dict[str, Any]:
+        if self.cache_key:
+            _cache_put(self.cache_key, normalized)
+        return normalized
+
+
+def _client_settings() -> tuple:
     endpoint = _normalize_endpoint(_clean_env(os.getenv("AZURE_DOC_INTEL_ENDPOINT")))
     key = _clean_env(os.getenv("AZURE_DOC_INTEL_KEY"))
 
@@ -42,7 +218,55 @@ def get_azure_client() -> DocumentAnalysisClient:
     if not key:
         raise AzureOCRError("AZURE_DOC_INTEL_KEY is not set.")
 
-    return DocumentAnalysisClient(endpoint=endpoint, credential=AzureKeyCredential(key))
+    return endpoint, AzureKeyCredential(key)
+
+
+@functools.lru_cache(maxsize=1)
+def get_azure_client() -> DocumentAnalysisClient:
+    """Shared sync client; built once so repeat calls reuse its HTTPS connection pool."""
+    endpoint, credential = _client_settings()
+    # Retries are handled by analyze_invoice_from_stream (same policy as the async path)
+    return DocumentAnalysisClient(endpoint=endpoint, credential=credential, retry_total=0)
+
+
+_async_client: Optional[AsyncDocumentAnalysisClient] = None
+
+
+def _build_async_transport() -> AioHttpTransport:
+    """aiohttp transport with a bigger keep-alive pool than the SDK default, so
+    bursts of uploads reuse warm TLS connections instead of handshaking."""
+    connector = aiohttp.TCPConnector(
+        limit=_env_int("AZURE_OCR_CONNECTION_LIMIT", 64),
+        keepalive_timeout=_env_int("AZURE_OCR_KEEPALIVE_SECONDS", 60),
+    )
+    return AioHttpTransport(session=aiohttp.ClientSession(connector=connector), session_owner=True)
+
+
+def get_async_azure_client() -> AsyncDocumentAnalysisClient:
+    """Module-level async client, reused across requests (one connection pool).
+    Must first be called inside the running event loop (startup or a request)."""
+    global _async_client
+    if _async_client is None:
+        endpoint, credential = _client_settings()
+        _async_client = AsyncDocumentAnalysisClient(
+            endpoint=endpoint,
+            credential=credential,
+            transport=_build_async_transport(),
+            retry_total=0,  # analyze_invoice_from_stream_async owns retry/backoff
+        )
+    return _async_client
+
+
+async def close_async_azure_client() -> None:
+    """Close the shared async client (call on application shutdown)."""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+
+
+# Fallback attributes checked after .content, in priority order
+_VALUE_ATTRS = ("value", "value_string", "value_number", "value_date")
 
 
 def _field_content(field: Any, default=None):
@@ -50,82 +274,181 @@ def _field_content(field: Any, default=None):
         return default
 
     content = getattr(field, "content", None)
-    if content not in (None, ""):
+    if content is not None and content != "":
         return content
 
-    for attr in ("value", "value_string", "value_number", "value_date"):
-        if hasattr(field, attr):
-            v = getattr(field, attr)
-            if v not in (None, ""):
-                return str(v)
+    # One getattr per attribute (missing ones fall back to None) instead of hasattr + getattr
+    for attr in _VALUE_ATTRS:
+        v = getattr(field, attr, None)
+        if v is not None and v != "":
+            return str(v)
 
     return default
 
 
+# (output key, Azure field name, default) for each line-item column
+_ITEM_SPEC = (
+    ("description", "Description", ""),
+    ("quantity", "Quantity", None),
+    ("unit", "Unit", None),
+    ("unit_price", "UnitPrice", None),
+    ("line_total", "Amount", None),
+    ("tax_amount", "Tax", None),
+    ("sku", "ProductCode", ""),
+    ("date", "Date", None),
+)
+
+
 def _parse_items(items_field: Any) -> List[Dict[str, Any]]:
-    items: List[Dict[str, Any]] = []
     if not items_field:
-        return items
+        return []
 
     value = getattr(items_field, "value", None)
     if not value:
-        return items
-
-    for it in value:
-        obj = getattr(it, "value", None) or {}
-        items.append(
-            {
-                "description": _field_content(obj.get("Description"), ""),
-                "quantity": _field_content(obj.get("Quantity")),
-                "unit": _field_content(obj.get("Unit")),
-                "unit_price": _field_content(obj.get("UnitPrice")),
-                "line_total": _field_content(obj.get("Amount")),
-                "tax_amount": _field_content(obj.get("Tax")),
-                "sku": _field_content(obj.get("ProductCode"), ""),
-                "date": _field_content(obj.get("Date")),
-            }
-        )
-    return items
+        return []
+
+    return [
+        {out_key: _field_content(obj.get(src_key), default) for out_key, src_key, default in _ITEM_SPEC}
+        for obj in ((getattr(it, "value", None) or {}) for it in value)
+    ]
+
+
+# Canadian sales-tax labels; their presence on the page classifies the invoice's tax
+TAX_MARKERS = ("HST", "GST", "PST")
+
+
+def _tax_markers(text: str) -> List[str]:
+    """Tax labels found anywhere in the document text (one uppercase pass, then C-level substring scans)."""
+    upper = text.upper()
+    return [marker for marker in TAX_MARKERS if marker in upper]
+
+
+def _normalize_result(result: Any) -> Dict[str, Any]:
+    if not result.documents:
+        raise AzureOCRError("No invoice document detected in the PDF")
+
+    doc = result.documents[0]
+    fields = getattr(doc, "fields", {}) or {}
+
+    return {
+        "vendor_name": _field_content(fields.get("VendorName"), ""),
+        "invoice_id": _field_content(fields.get("InvoiceId"), ""),
+        "invoice_date": _field_content(fields.get("InvoiceDate")),
+        "due_date": _field_content(fields.get("DueDate")),
+        "currency": _field_content(fields.get("CurrencyCode")),
+        "subtotal": _field_content(fields.get("SubTotal")),
+        "tax_total": _field_content(fields.get("TotalTax")),
+        "total": _field_content(fields.get("InvoiceTotal")),
+        "customer_name": _field_content(fields.get("CustomerName"), ""),
+        "customer_address": _field_content(fields.get("CustomerAddress")),
+        "vendor_address": _field_content(fields.get("VendorAddress")),
+        "items": _parse_items(fields.get("Items")),
+        "tax_markers": _tax_markers(getattr(result, "content", None) or ""),
+    }
 
 
 def analyze_invoice_from_bytes(file_bytes: bytes) -> Dict[str, Any]:
     """
     Analyze invoice PDF using the prebuilt invoice model.
-    Returns a normalized dict.
+    Returns a normalized dict. Results are cached by content hash
+    unless OCR_CACHE_ENABLED is turned off.
     """
-    try:
-        client = get_azure_client()
+    cache_key = document_hash(file_bytes) if _cache_enabled() else None
+    return analyze_invoice_from_stream(io.BytesIO(file_bytes), cache_key)
 
-        # Call begin_analyze_document with document as keyword argument
-        # content_type is auto-detected for byte streams
-        poller = client.begin_analyze_document(
-            model_id="prebuilt-invoice",
-            document=file_bytes,
-        )
-        result = poller.result()
-
-        if not result.documents:
-            raise AzureOCRError("No invoice document detected in the PDF")
-
-        doc = result.documents[0]
-        fields = getattr(doc, "fields", {}) or {}
-
-        normalized = {
-            "vendor_name": _field_content(fields.get("VendorName"), ""),
-            "invoice_id": _field_content(fields.get("InvoiceId"), ""),
-            "invoice_date": _field_content(fields.get("InvoiceDate")),
-            "due_date": _field_content(fields.get("DueDate")),
-            "currency": _field_content(fields.get("CurrencyCode")),
-            "subtotal": _field_content(fields.get("SubTotal")),
-            "tax_total": _field_content(fields.get("TotalTax")),
-            "total": _field_content(fields.get("InvoiceTotal")),
-            "customer_name": _field_content(fields.get("CustomerName"), ""),
-            "customer_address": _field_content(fields.get("CustomerAddress")),
-            "vendor_address": _field_content(fields.get("VendorAddress")),
-            "items": _parse_items(fields.get("Items")),
-        }
 
-        return normalized
+def analyze_invoice_from_stream(stream: BinaryIO, content_hash: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Sync variant of analyze_invoice_from_stream_async: the SDK reads the
+    open file itself, so callers need not hold the document as bytes.
+    content_hash is the document_hasher() digest of the stream, used as cache key.
+    """
+    attempts = _OCRAttempts(content_hash)
+    if attempts.cached is not None:
+        return attempts.cached
+
+    for attempt in attempts:
+        try:
+            client = get_azure_client()
+            # content_type is auto-detected for byte streams
+            stream.seek(0)  # a retry must resend the whole document
+            poller = client.begin_analyze_document(
+                model_id="prebuilt-invoice",
+                document=stream,
+            )
+            normalized = _normalize_result(poller.result())
+            break
+        except Exception as e:
+            time.sleep(attempts.backoff(e, attempt))
+
+    return attempts.done(normalized)
+
+
+async def analyze_invoice_from_bytes_async(file_bytes: bytes) -> Dict[str, Any]:
+    """Async variant of analyze_invoice_from_bytes for use inside the API event loop."""
+    return await analyze_invoice_from_stream_async(io.BytesIO(file_bytes), document_hash(file_bytes))
+
+
+async def analyze_invoice_from_stream_async(stream: BinaryIO, content_hash: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Analyze an invoice from a readable binary stream (e.g. a spooled upload),
+    so the SDK reads the file itself instead of needing a full bytes copy.
+    content_hash is the document_hasher() digest of the stream, used as cache key.
+    """
+    attempts = _OCRAttempts(content_hash)
+    if attempts.cached is not None:
+        return attempts.cached
+
+    for attempt in attempts:
+        try:
+            client = get_async_azure_client()
+            # Hold the semaphore only for the Azure call, not the backoff sleep
+            async with _get_ocr_semaphore():
+                await _get_ocr_rate_limiter().wait()
+                stream.seek(0)  # a retry must resend the whole document
+                with OCR_SECONDS.time(), OCR_INFLIGHT.track_inprogress():
+                    poller = await client.begin_analyze_document(
+                        model_id="prebuilt-invoice",
+                        document=stream,
+                    )
+                    normalized = _normalize_result(await poller.result())
+            break
+        except Exception as e:
+            await asyncio.sleep(attempts.backoff(e, attempt))
+
+    return attempts.done(normalized)
+
+
+async def analyze_invoices_from_streams_async(
+    documents: Sequence[Tuple[BinaryIO, Optional[str]]],
+) -> List[Union[Dict[str, Any], AzureOCRError]]:
+    """
+    Analyze a batch of (stream, content_hash) documents concurrently.
+    Identical documents in the batch share a single Azure call, and every call
+    goes through the same semaphore/retry path as single uploads.
+    Results come back in input order; a failed document yields its AzureOCRError
+    instead of failing the whole batch.
+    """
+    tasks: Dict[Any, "asyncio.Task"] = {}
+    order = []
+    for index, (stream, content_hash) in enumerate(documents):
+        key = content_hash or ("__unhashed__", index)
+        if key not in tasks:
+            tasks[key] = asyncio.ensure_future(analyze_invoice_from_stream_async(stream, content_hash))
+        order.append(key)
+
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
 
-    except Exception as e:
-        raise AzureOCRError(str(e)) from e
+    results: List[Union[Dict[str, Any], AzureOCRError]] = []
+    seen = set()
+    for key in order:
+        task = tasks[key]
+        exc = task.exception()
+        if exc is not None:
+            results.append(exc if isinstance(exc, AzureOCRError) else AzureOCRError(str(exc)))
+        elif key in seen:
+            results.append(copy.deepcopy(task.result()))  # each caller gets its own dict
+        else:
+            results.append(task.result())
+        seen.add(key)
+    return results
@@ -1,11 +1,121 @@
 # file: init_db.py
+import logging
+from contextlib import contextmanager
+
+from sqlalchemy import inspect, text
+
 from database import engine, Base
 from models import Invoice, PriceHistory, PriceChange, ActivityLog
 
+logger = logging.getLogger(__name__)
+
+# Arbitrary app-wide key for pg_advisory_lock; every worker uses the same one
+MIGRATION_LOCK_KEY = 0x0CA9_1000
+
+
+@contextmanager
+def migration_lock():
+    """Serialize schema setup across workers starting at once (Postgres only).
+    The first worker to get the lock runs the DDL; the others block here, then
+    find the schema current and issue nothing. Other dialects run unguarded."""
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+
+class MigrationBlocked(RuntimeError):
+    """Existing data prevents a schema change; startup must stop until it is fixed by hand."""
+
+
+def assert_unique_csv_numbers():
+    """uq_invoice_csv_number cannot be built over duplicate CSV-imported invoice numbers
+    (left by concurrent imports before it existed). Removing them deletes invoices and
+    their price history, so that is left to an operator rather than done at startup."""
+    with engine.connect() as conn:
+        duplicates = conn.execute(text(
+            "SELECT invoice_number FROM invoices"
+            " WHERE source = 'csv_import' AND invoice_number IS NOT NULL"
+            " GROUP BY invoice_number HAVING COUNT(*) > 1"
+            " ORDER BY invoice_number LIMIT 20"
+        )).scalars().all()
+    if duplicates:
+        raise MigrationBlocked(
+            "Cannot create index uq_invoice_csv_number: invoices contains duplicate CSV-imported "
+            f"invoice numbers ({', '.join(duplicates)}). Delete the extra copies "
+            "(DELETE /api/invoices/{id}) and restart."
+        )
+
+
+# Checks run before building an index on an existing table; they raise MigrationBlocked
+INDEX_PRECHECKS = {
+    "uq_invoice_csv_number": assert_unique_csv_numbers,
+}
+
+
+def ensure_indexes(inspector, existing_tables):
+    """Create indexes declared in models that are missing on existing tables.
+    create_all() only builds indexes together with a brand-new table."""
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        present = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in present:
+                precheck = INDEX_PRECHECKS.get(index.name)
+                if precheck:
+                    precheck()
+                index.create(bind=engine)
+                logger.info(f"Created index {index.name}")
+
+
+# Indexes once declared in models that no query needs any more; each one only
+# cost B-tree maintenance on every insert (bulk CSV imports in particular)
+OBSOLETE_INDEXES = {
+    "invoices": ("ix_invoices_id",),  # duplicate of the primary key
+    "price_history": (
+        "ix_price_history_id",  # duplicate of the primary key
+        "ix_price_history_vendor_name",  # price lookups go through invoice_id
+        "ix_price_history_item_description",
+    ),
+    "price_changes": ("ix_price_changes_id",),  # duplicate of the primary key
+}
+
+
+def drop_obsolete_indexes(inspector, existing_tables):
+    """Drop OBSOLETE_INDEXES still present on existing tables."""
+    stale = [
+        name
+        for table, names in OBSOLETE_INDEXES.items() if table in existing_tables
+        for name in set(names) & {ix["name"] for ix in inspector.get_indexes(table)}
+    ]
+    if not stale:
+        return
+    with engine.begin() as conn:
+        for name in stale:
+            conn.execute(text(f'DROP INDEX "{name}"'))
+            logger.info(f"Dropped index {name}")
+
+
 def init_database():
-    """Create all database tables"""
-    Base.metadata.create_all(bind=engine)
-    print("Database tables created successfully!")
+    """Create missing database tables and indexes.
+    A single reflection pass decides what is missing, so a restart against an
+    up-to-date schema issues no DDL and no per-table existence checks."""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = [t for t in Base.metadata.sorted_tables if t.name not in existing_tables]
+    if missing:
+        Base.metadata.create_all(bind=engine, tables=missing, checkfirst=False)
+        logger.info(f"Created tables: {', '.join(t.name for t in missing)}")
+    ensure_indexes(inspector, existing_tables)
+    drop_obsolete_indexes(inspector, existing_tables)
+    logger.info("Database tables created successfully!")
 
 if __name__ == "__main__":
-    init_database()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    init_database()
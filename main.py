@@ -2,33 +2,54 @@
 """
 FastAPI backend for retail/grocery invoice management with Azure OCR processing and price change tracking."""
 
-import os
+import asyncio
+import csv
+import hashlib
+import io
 import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, Any, Optional, List
+from typing import BinaryIO, Dict, Any, List, NamedTuple, Optional, Tuple
 from urllib.parse import urlparse
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-
-from azure_ocr import analyze_invoice_from_bytes, AzureOCRError
-import json
-import csv
-import io
-from datetime import datetime
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from database import engine, SessionLocal
-from models import Invoice, PriceHistory, PriceChange, ActivityLog
-from init_db import init_database
 
 # --- Load .env explicitly from this project folder (Windows-safe) ---
+# Must run before the local imports below: database.py reads DATABASE_URL at import.
+# SKIP_DOTENV=1 skips it where the environment is already provided (tests, containers).
 PROJECT_DIR = Path(__file__).resolve().parent
 DOTENV_PATH = PROJECT_DIR / ".env"
-DOTENV_LOADED = load_dotenv(dotenv_path=DOTENV_PATH, override=False)
+DOTENV_LOADED = False if os.getenv("SKIP_DOTENV") == "1" else load_dotenv(dotenv_path=DOTENV_PATH, override=False)
+
+import orjson
+from fastapi import BackgroundTasks, Depends, FastAPI, File, Request, Response, UploadFile, HTTPException
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel
+from sqlalchemy import and_, bindparam, delete, exists, func, insert, inspect, or_, select, text, update
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, defer
+
+from azure_ocr import (
+    analyze_invoice_from_stream_async,
+    analyze_invoices_from_streams_async,
+    close_async_azure_client,
+    document_hasher,
+    get_async_azure_client,
+    AzureOCRError,
+)
+from database import engine, SessionLocal, get_db, warm_pool
+from metrics import DB_COMMIT_SECONDS, UPLOAD_SPOOL_SECONDS, register_pool_metrics, render_metrics, track_request_latency
+from models import Invoice, PriceHistory, PriceChange, ActivityLog
+from init_db import MigrationBlocked, init_database, migration_lock
 
 # Configure logging
 logging.basicConfig(
@@ -49,7 +70,16 @@ DEPARTMENT_MANAGERS = {
     "contractor": "Kevin Taylor"
 }
 
-DEPARTMENTS = list(DEPARTMENT_MANAGERS.keys())
+DEPARTMENTS = frozenset(DEPARTMENT_MANAGERS)        # O(1) membership checks
+DEPARTMENT_LIST = ", ".join(DEPARTMENT_MANAGERS)   # stable order for error messages
+
+
+def resolve_department_manager(department: str) -> str:
+    """Validate a department and return its manager in one dict lookup."""
+    manager = DEPARTMENT_MANAGERS.get(department)
+    if manager is None:
+        raise HTTPException(400, f"Invalid department. Must be one of: {DEPARTMENT_LIST}")
+    return manager
 
 
 # ========== PYDANTIC REQUEST MODELS ==========
@@ -86,9 +116,55 @@ class PriceChangeReviewRequest(BaseModel):
     review_notes: Optional[str] = None
 
 
-def get_db_session() -> Session:
-    """Create a new database session (caller must close it)."""
-    return SessionLocal()
+# ========== UPLOAD SPOOLING ==========
+UPLOAD_CHUNK_SIZE = 1 << 20      # 1 MB reads from the request body
+UPLOAD_SPOOL_MAX_SIZE = 8 << 20  # keep uploads up to 8 MB in memory, spill larger ones to disk
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 << 20)))  # 50 MB default
+PDF_MAGIC = b"%PDF-"
+PDF_HEADER_WINDOW = 1024         # readers accept the %PDF- header anywhere in the first 1 KB
+MULTIPART_OVERHEAD = 64 << 10    # slack for boundaries / part headers around the file in Content-Length
+
+
+def content_length_limit(max_file_bytes: int, max_files: int = 1):
+    """Route dependency: use the declared Content-Length to reject empty or oversize
+    bodies before the file is spooled, hashed or sent to Azure. Chunked uploads carry
+    no Content-Length and are let through; spool_upload caps them at MAX_UPLOAD_BYTES."""
+    limit = max_file_bytes * max_files + MULTIPART_OVERHEAD
+
+    def check_content_length(request: Request):
+        content_length = request.headers.get("content-length")
+        if content_length is None or not content_length.isdigit():
+            return
+        if int(content_length) == 0:
+            raise HTTPException(status_code=400, detail="No file provided")
+        if int(content_length) > limit:
+            raise HTTPException(status_code=413, detail=f"File too large. Maximum upload size is {max_file_bytes // (1 << 20)} MB per file.")
+
+    return check_content_length
+
+
+async def spool_upload(file: UploadFile) -> Tuple[tempfile.SpooledTemporaryFile, str, int]:
+    """Copy an upload into a SpooledTemporaryFile in chunks, hashing as it streams.
+    The first chunk doubles as the PDF signature check, so non-PDFs are rejected
+    before the rest of the body is read or sent to Azure; the copy stops as soon
+    as MAX_UPLOAD_BYTES is exceeded.
+    Returns (spool, content_hash, size); caller must close the spool."""
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_SIZE)
+    hasher = document_hasher()
+    size = 0
+    with UPLOAD_SPOOL_SECONDS.time():
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            if not size and PDF_MAGIC not in chunk[:PDF_HEADER_WINDOW]:
+                spool.close()
+                raise HTTPException(status_code=415, detail="Invalid file. Content is not a PDF document.")
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                spool.close()
+                raise HTTPException(status_code=413, detail=f"File too large. Maximum upload size is {MAX_UPLOAD_BYTES // (1 << 20)} MB.")
+            spool.write(chunk)
+            hasher.update(chunk)
+    spool.seek(0)
+    return spool, hasher.hexdigest(), size
 
 
 # ========== ACTIVITY LOG HELPER ==========
@@ -130,6 +206,12 @@ def log_activity(
         logger.warning(f"Failed to write activity log: {e}")
 
 
+# Built once: single-char symbols/separators dropped in one C-level translate pass,
+# multi-char currency codes in one precompiled regex pass
+_PRICE_STRIP_TABLE = str.maketrans("", "", "$, £€")
+_CURRENCY_CODE_RE = re.compile(r"CAD|USD|EUR|GBP")
+
+
 def clean_price(value) -> Optional[float]:
     """Convert OCR price strings like '$1,533.48' to float.
     Returns None if the value cannot be parsed."""
@@ -138,12 +220,8 @@ def clean_price(value) -> Optional[float]:
     if isinstance(value, (int, float)):
         return float(value)
     if isinstance(value, str):
-        # Remove $, commas, spaces, and other currency symbols
-        cleaned = value.strip().replace("$", "").replace(",", "").replace(" ", "")
-        # Remove other common currency prefixes/suffixes
-        for sym in ["CAD", "USD", "EUR", "GBP", "£", "€"]:
-            cleaned = cleaned.replace(sym, "")
-        cleaned = cleaned.strip()
+        # Remove $, commas, spaces, £/€, then currency codes (CAD, USD, EUR, GBP)
+        cleaned = _CURRENCY_CODE_RE.sub("", value.translate(_PRICE_STRIP_TABLE)).strip()
         if not cleaned:
             return None
         try:
@@ -157,11 +235,12 @@ def clean_price(value) -> Optional[float]:
 def clean_line_items(items: list) -> list:
     """Clean all price fields in OCR line items so they are proper floats."""
     cleaned = []
+    cp = clean_price  # local lookup in the per-item loop
     for item in items:
         cleaned_item = dict(item)  # shallow copy
-        cleaned_item["unit_price"] = clean_price(item.get("unit_price"))
-        cleaned_item["line_total"] = clean_price(item.get("line_total"))
-        cleaned_item["tax_amount"] = clean_price(item.get("tax_amount"))
+        cleaned_item["unit_price"] = cp(item.get("unit_price"))
+        cleaned_item["line_total"] = cp(item.get("line_total"))
+        cleaned_item["tax_amount"] = cp(item.get("tax_amount"))
         # Clean quantity too (sometimes comes as string)
         qty = item.get("quantity")
         if qty is not None:
@@ -175,156 +254,377 @@ def clean_line_items(items: list) -> list:
 
 def save_price_history(db: Session, invoice: Invoice):
     """Save all line items from an approved invoice into price_history for future comparisons."""
-    items = json.loads(invoice.items_json) if invoice.items_json else []
+    items = invoice.items_json or []
     if not items or not invoice.vendor_name:
         return
 
-    count = 0
+    # Per-invoice values hoisted out of the loop
+    invoice_id = invoice.id
+    vendor = invoice.vendor_name.strip()
+    invoice_date = invoice.invoice_date
+    department = invoice.department
+    cp = clean_price
+
+    rows = []
     for item in items:
         description = (item.get("description") or "").strip()
         if not description:
             continue
 
-        ph = PriceHistory(
-            invoice_id=invoice.id,
-            vendor_name=invoice.vendor_name.strip(),
-            item_description=description,
-            item_sku=item.get("sku") or None,
-            unit_price=clean_price(item.get("unit_price")),
-            quantity=float(item["quantity"]) if item.get("quantity") else None,
-            unit=item.get("unit") or None,
-            line_total=clean_price(item.get("line_total")),
-            invoice_date=invoice.invoice_date,
-            department=invoice.department,
+        rows.append({
+            "invoice_id": invoice_id,
+            "vendor_name": vendor,
+            "item_description": description,
+            "item_sku": item.get("sku") or None,
+            "unit_price": cp(item.get("unit_price")),
+            "quantity": float(item["quantity"]) if item.get("quantity") else None,
+            "unit": item.get("unit") or None,
+            "line_total": cp(item.get("line_total")),
+            "invoice_date": invoice_date,
+            "department": department,
+        })
+
+    # Never read back: one executemany INSERT, no PriceHistory objects in the session
+    if rows:
+        db.execute(insert(PriceHistory), rows)
+
+    logger.info(f"Saved {len(rows)} price history records for invoice {invoice_id} ({invoice.vendor_name})")
+
+
+# ========== PREVIOUS-INVOICE CACHE ==========
+# vendor -> baseline used by detect_price_changes, so a burst of approvals for one vendor
+# skips the previous-invoice query and the price_history load. Kept current on approval
+# (the approved invoice becomes the baseline), dropped on delete / CSV import; the TTL
+# bounds staleness from other workers.
+PREV_INVOICE_TTL = 60.0
+PRICE_TRACKED_STATUSES = ("approved", "price_review", "complete")
+
+
+class PrevInvoice(NamedTuple):
+    id: int
+    invoice_date: Optional[str]
+    created_at: Optional[datetime]
+
+
+_prev_invoice_cache: Dict[str, Tuple[float, PrevInvoice, Dict[str, float]]] = {}
+_prev_invoice_lock = threading.Lock()
+
+
+def cached_prev_invoice(vendor: str, exclude_id: int) -> Optional[Tuple[PrevInvoice, Dict[str, float]]]:
+    with _prev_invoice_lock:
+        entry = _prev_invoice_cache.get(vendor)
+    if not entry:
+        return None
+    expires, prev_invoice, prev_prices = entry
+    if expires <= time.monotonic() or prev_invoice.id == exclude_id:
+        return None
+    return prev_invoice, prev_prices
+
+
+def cache_prev_invoice(vendor: str, prev_invoice: PrevInvoice, prev_prices: Dict[str, float]):
+    with _prev_invoice_lock:
+        _prev_invoice_cache[vendor] = (time.monotonic() + PREV_INVOICE_TTL, prev_invoice, prev_prices)
+
+
+def remember_approved_prices(invoice: Invoice):
+    """Call after an approval commits: the approved invoice is now its vendor's newest baseline
+    (unless the cached one was created later). Prices mirror what save_price_history stored."""
+    vendor = (invoice.vendor_name or "").strip()
+    if not vendor or invoice.stage_status not in PRICE_TRACKED_STATUSES:
+        return
+    with _prev_invoice_lock:
+        entry = _prev_invoice_cache.get(vendor)
+        if not entry:
+            return
+        cached = entry[1]
+        if invoice.created_at is None or cached.created_at is None:
+            _prev_invoice_cache.pop(vendor, None)
+            return
+        if invoice.created_at < cached.created_at:
+            return
+        prices = {}
+        for item in invoice.items_json or []:
+            description = (item.get("description") or "").strip()
+            price = clean_price(item.get("unit_price")) if description else None
+            if price is not None:
+                prices[description.casefold()] = price
+        _prev_invoice_cache[vendor] = (
+            time.monotonic() + PREV_INVOICE_TTL,
+            PrevInvoice(invoice.id, invoice.invoice_date, invoice.created_at),
+            prices,
         )
-        db.add(ph)
-        count += 1
 
-    logger.info(f"Saved {count} price history records for invoice {invoice.id} ({invoice.vendor_name})")
+
+def invalidate_prev_invoice_cache(vendor: Optional[str] = None):
+    """Drop one vendor's baseline, or all of them when vendor is None."""
+    with _prev_invoice_lock:
+        if vendor is None:
+            _prev_invoice_cache.clear()
+        else:
+            _prev_invoice_cache.pop(vendor.strip(), None)
+
+
+def release_prev_invoice(vendor: Optional[str], old_status: Optional[str]):
+    """Call after committing a move out of PRICE_TRACKED_STATUSES (reject, re-code):
+    a baseline cached from this invoice must not outlive the commit."""
+    if vendor and old_status in PRICE_TRACKED_STATUSES:
+        invalidate_prev_invoice_cache(vendor)
 
 
 def detect_price_changes(db: Session, invoice: Invoice) -> int:
     """Compare line items against the most recent previous invoice from the same vendor.
     Creates PriceChange records for any differences. Returns count of changes found."""
-    items = json.loads(invoice.items_json) if invoice.items_json else []
+    items = invoice.items_json or []
     if not items or not invoice.vendor_name:
         return 0
 
     vendor = invoice.vendor_name.strip()
 
-    # Find the most recent previous invoice ID from this vendor (not the current one)
-    prev_invoice = db.query(Invoice).filter(
-        Invoice.vendor_name == vendor,
-        Invoice.id != invoice.id,
-        Invoice.stage_status.in_(["approved", "price_review", "complete"])
-    ).order_by(Invoice.created_at.desc()).first()
-
-    if not prev_invoice:
-        logger.info(f"No previous invoice found for vendor '{vendor}' - skipping price comparison")
-        return 0
-
-    # Build a lookup of previous prices: description -> PriceHistory record
-    prev_prices = {}
-    prev_history = db.query(PriceHistory).filter(
-        PriceHistory.invoice_id == prev_invoice.id
-    ).all()
-
-    for ph in prev_history:
-        key = ph.item_description.strip().lower()
-        prev_prices[key] = ph
+    cached = cached_prev_invoice(vendor, invoice.id)
+    if cached:
+        prev_invoice, prev_prices = cached
+    else:
+        # Find the most recent previous invoice ID from this vendor (not the current one)
+        row = db.execute(
+            select(Invoice.id, Invoice.invoice_date, Invoice.created_at)
+            .where(
+                Invoice.vendor_name == vendor,
+                Invoice.id != invoice.id,
+                Invoice.stage_status.in_(PRICE_TRACKED_STATUSES),
+            )
+            .order_by(Invoice.created_at.desc())
+            .limit(1)
+        ).first()
+
+        if not row:
+            logger.info(f"No previous invoice found for vendor '{vendor}' - skipping price comparison")
+            return 0
+        prev_invoice = PrevInvoice(*row)
+
+        # Build a lookup of previous prices: casefolded description -> unit price
+        # Two-column rows, no PriceHistory entities; rows without a price can never be a change
+        prev_prices = {
+            description.strip().casefold(): unit_price
+            for description, unit_price in db.execute(
+                select(PriceHistory.item_description, PriceHistory.unit_price).where(
+                    PriceHistory.invoice_id == prev_invoice.id,
+                    PriceHistory.unit_price.isnot(None),
+                )
+            )
+        }
+        cache_prev_invoice(vendor, prev_invoice, prev_prices)
 
     # Compare each current item against previous
-    changes_found = 0
+    changes = []
     for item in items:
         description = (item.get("description") or "").strip()
         if not description:
             continue
 
+        # Look up first: items new to this vendor skip price parsing entirely
+        prev_price = prev_prices.get(description.casefold())
+        if prev_price is None:
+            continue  # New item or no previous price — not a change
+
         current_price = clean_price(item.get("unit_price"))
         if current_price is None:
             continue
 
-        key = description.lower()
-        prev = prev_prices.get(key)
-
-        if not prev or prev.unit_price is None:
-            continue  # New item or no previous price — not a change
-
-        if abs(current_price - prev.unit_price) < 0.001:
+        if abs(current_price - prev_price) < 0.001:
             continue  # Same price — no change
 
         # Price changed — create record
-        diff = current_price - prev.unit_price
-        pct = (diff / prev.unit_price) * 100 if prev.unit_price != 0 else 0
+        diff = current_price - prev_price
+        pct = (diff / prev_price) * 100 if prev_price != 0 else 0
 
-        pc = PriceChange(
+        changes.append(PriceChange(
             invoice_id=invoice.id,
             previous_invoice_id=prev_invoice.id,
             vendor_name=vendor,
             item_description=description,
             item_sku=item.get("sku") or None,
             department=invoice.department,
-            previous_price=prev.unit_price,
+            previous_price=prev_price,
             new_price=current_price,
             price_difference=round(diff, 2),
             percent_change=round(pct, 2),
             previous_invoice_date=prev_invoice.invoice_date,
             new_invoice_date=invoice.invoice_date,
-        )
-        db.add(pc)
-        changes_found += 1
+        ))
 
         logger.info(
             f"Price change detected: {vendor} / {description}: "
-            f"${prev.unit_price:.2f} -> ${current_price:.2f} ({pct:+.1f}%)"
+            f"${prev_price:.2f} -> ${current_price:.2f} ({pct:+.1f}%)"
         )
 
-    return changes_found
+    # Added together so the flush sends them as one batched INSERT
+    db.add_all(changes)
+    return len(changes)
+
+
+def migrate_database():
+    """Create tables and apply in-place column migrations.
+    Runs under migration_lock so N workers booting together don't race on the same DDL.
+    MigrationBlocked stops startup: the app must not run without the schema it relies on."""
+    global FK_CASCADE_DELETES
+    try:
+        with migration_lock():
+            apply_migrations()
+    except MigrationBlocked as e:
+        logger.critical(f"Database migration blocked: {e}")
+        raise
+    except Exception as e:
+        logger.error(f"Database initialization failed: {e}")
+
+    # Decided from the live schema, not the dialect: a partial migration must not
+    # make delete_invoice skip the child deletes
+    try:
+        FK_CASCADE_DELETES = cascade_deletes_in_place()
+    except Exception as e:
+        FK_CASCADE_DELETES = False
+        logger.warning(f"Could not inspect foreign keys, deleting children explicitly: {e}")
+    logger.info(f"Invoice deletes cascade via foreign keys: {FK_CASCADE_DELETES}")
+
+
+CASCADE_CHILD_TABLES = ("price_history", "price_changes")
+
+
+def cascade_deletes_in_place() -> bool:
+    """Whether deleting an invoice removes its price history / price changes by itself:
+    FK enforcement is on and every child FK -> invoices is reported as ON DELETE CASCADE."""
+    with engine.connect() as conn:
+        if engine.dialect.name == "sqlite" and not conn.exec_driver_sql("PRAGMA foreign_keys").scalar():
+            return False
+        inspector = inspect(conn)
+        fks = [
+            fk
+            for table in CASCADE_CHILD_TABLES
+            for fk in inspector.get_foreign_keys(table)
+            if fk["referred_table"] == "invoices"
+        ]
+    return bool(fks) and all((fk.get("options") or {}).get("ondelete") == "CASCADE" for fk in fks)
+
+
+def migrate_cascade_fks():
+    """Recreate child FKs -> invoices with ON DELETE CASCADE (delete_invoice is then one DELETE).
+    Its own transaction, so an earlier migration's failure cannot skip it; a failure here
+    stops startup rather than leaving the schema half-migrated."""
+    try:
+        with engine.begin() as conn:
+            inspector = inspect(conn)
+            for table in CASCADE_CHILD_TABLES:
+                for fk in inspector.get_foreign_keys(table):
+                    if fk["referred_table"] != "invoices" or (fk.get("options") or {}).get("ondelete") == "CASCADE":
+                        continue
+                    column = fk["constrained_columns"][0]
+                    conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{fk["name"]}"'))
+                    conn.execute(text(
+                        f'ALTER TABLE {table} ADD CONSTRAINT "{fk["name"]}" '
+                        f"FOREIGN KEY ({column}) REFERENCES invoices (id) ON DELETE CASCADE"
+                    ))
+                    logger.info(f"Recreated {table}.{column} foreign key with ON DELETE CASCADE")
+    except Exception as e:
+        raise MigrationBlocked(f"Could not recreate invoice foreign keys with ON DELETE CASCADE: {e}") from e
+
+
+def apply_migrations():
+    """Schema setup proper; idempotent, so a worker that waited on the lock issues no DDL."""
+    init_database()
+    logger.info("Database initialized successfully")
+    
+    # Auto-migrate: add any missing columns to existing tables
+    with engine.connect() as conn:
+        inspector = inspect(engine)
+        
+        # Check invoices table for new columns
+        existing_cols = {col["name"] for col in inspector.get_columns("invoices")}
+        
+        migrations = {
+            "price_changes_detected": "ALTER TABLE invoices ADD COLUMN price_changes_detected BOOLEAN DEFAULT FALSE",
+            "price_change_count": "ALTER TABLE invoices ADD COLUMN price_change_count INTEGER DEFAULT 0",
+        }
+        
+        for col_name, sql in migrations.items():
+            if col_name not in existing_cols:
+                conn.execute(text(sql))
+                logger.info(f"Added missing column: invoices.{col_name}")
+        
+        # items_json moved from TEXT to JSONB (decoded by the driver, no per-row parse)
+        if engine.dialect.name == "postgresql":
+            items_col = next(col for col in inspector.get_columns("invoices") if col["name"] == "items_json")
+            if not isinstance(items_col["type"], JSONB):
+                conn.execute(text(
+                    "ALTER TABLE invoices ALTER COLUMN items_json TYPE jsonb USING items_json::jsonb"
+                ))
+                logger.info("Converted invoices.items_json to JSONB")
+        
+        conn.commit()
+    
+    # SQLite can't ALTER constraints; its new tables get CASCADE from the models
+    if engine.dialect.name == "postgresql":
+        migrate_cascade_fks()
+    
+    logger.info(f"Connection pool: {engine.pool.status()}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Startup: schema + migrations, pre-warmed DB pool, shared OCR client. Shutdown: close the client."""
+    migrate_database()
+
+    try:
+        warm_pool()
+        logger.info(f"Connection pool warmed: {engine.pool.status()}")
+    except Exception as e:
+        logger.warning(f"Connection pool warm-up failed: {e}")
+
+    # Build the Azure OCR client once so every upload reuses its connection pool
+    try:
+        app.state.ocr_client = get_async_azure_client()
+    except AzureOCRError as e:
+        app.state.ocr_client = None
+        logger.warning(f"Azure OCR client not configured: {e}")
+
+    yield
+
+    await close_async_azure_client()
 
 
 app = FastAPI(
     title="Retail Invoice Management API",
     description="Backend API for retail/grocery invoice processing with OCR and price change tracking",
     version="1.0.0",
+    default_response_class=ORJSONResponse,  # orjson for every response body
+    lifespan=lifespan,
 )
 
+# Comma-separated allow-list; unset keeps the permissive dev default ("*") without credentials,
+# so any origin can read responses but never with the user's cookies / auth.
+# Exact origins skip Starlette's wildcard-echo path, and max_age lets browsers cache preflights.
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # tighten in production
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ORIGINS or ["*"],
+    allow_credentials=bool(CORS_ORIGINS),
+    allow_methods=["GET", "POST", "DELETE"],
+    allow_headers=["Content-Type", "Authorization", "If-None-Match"],
+    expose_headers=["ETag"],
+    max_age=86400,
 )
 
-@app.on_event("startup")
-async def startup_event():
-    """Initialize database on startup"""
-    try:
-        init_database()
-        logger.info("Database initialized successfully")
-        
-        # Auto-migrate: add any missing columns to existing tables
-        from sqlalchemy import text, inspect
-        with engine.connect() as conn:
-            inspector = inspect(engine)
-            
-            # Check invoices table for new columns
-            existing_cols = {col["name"] for col in inspector.get_columns("invoices")}
-            
-            migrations = {
-                "price_changes_detected": "ALTER TABLE invoices ADD COLUMN price_changes_detected BOOLEAN DEFAULT FALSE",
-                "price_change_count": "ALTER TABLE invoices ADD COLUMN price_change_count INTEGER DEFAULT 0",
-            }
-            
-            for col_name, sql in migrations.items():
-                if col_name not in existing_cols:
-                    conn.execute(text(sql))
-                    logger.info(f"Added missing column: invoices.{col_name}")
-            
-            conn.commit()
-        
-    except Exception as e:
-        logger.error(f"Database initialization failed: {e}")
+# JSON lists (recent invoices, queues, history) compress 5-10x; tiny bodies and 304s are skipped
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+app.middleware("http")(track_request_latency)
+register_pool_metrics(engine)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape endpoint."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
 
 
 @app.get("/")
@@ -332,12 +632,33 @@ async def root():
     return {
         "status": "healthy",
         "message": "Retail Invoice Management API is running",
-        "endpoints": {"health": "/health", "upload_invoice": "/upload-invoice-pdf"},
+        "endpoints": {
+            "health": "/health",
+            "upload_invoice": "/upload-invoice-pdf",
+            "upload_invoice_async": "/upload-invoice-pdf/async",
+            "upload_invoices": "/upload-invoice-pdfs",
+        },
     }
 
 
-@app.get("/health")
-async def health_check():
+# ========== ETAGS ==========
+def etag_matches(request: Request, etag: str) -> bool:
+    """True if the client's If-None-Match already names this ETag (or is a wildcard)."""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in (tag.strip() for tag in if_none_match.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+HEALTH_CACHE_TTL = 30.0  # seconds; short enough to pick up a rotated key / .env edit
+_health_cache: Tuple[float, bytes, str] = (0.0, b"", "")
+
+
+def health_payload() -> Dict[str, Any]:
     endpoint_raw = (os.getenv("AZURE_DOC_INTEL_ENDPOINT") or "")
     key_raw = (os.getenv("AZURE_DOC_INTEL_KEY") or "")
 
@@ -367,89 +688,140 @@ async def health_check():
     }
 
 
-@app.post("/upload-invoice-pdf")
-async def upload_invoice_pdf(file: UploadFile = File(...)) -> Dict[str, Any]:
-    if not file.filename:
-        raise HTTPException(status_code=400, detail="No file provided")
+def cached_health() -> Tuple[bytes, str]:
+    """Encoded /health body and its ETag, rebuilt at most once per HEALTH_CACHE_TTL."""
+    global _health_cache
+    expires, body, etag = _health_cache
+    now = time.monotonic()
+    if now >= expires:
+        body = orjson.dumps(health_payload())
+        etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+        _health_cache = (now + HEALTH_CACHE_TTL, body, etag)
+    return body, etag
 
-    if not file.filename.lower().endswith(".pdf"):
-        raise HTTPException(status_code=400, detail="Invalid file. Only PDF files are accepted.")
 
-    logger.info(f"Received invoice upload: {file.filename}")
+@app.get("/health")
+async def health_check(request: Request):
+    body, etag = cached_health()
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+@DB_COMMIT_SECONDS.time()
+def persist_ocr_invoices(entries: List[Tuple[Dict[str, Any], list, Dict[str, Any]]]) -> List[Tuple[Optional[int], Optional[str]]]:
+    """Insert OCR'd invoices, given as (invoice_fields, items, ocr_result), plus their upload activity entries.
+    Returns (invoice_id, None) or (None, error) per entry, in order. Each invoice gets its own
+    SAVEPOINT, so a bad row is reported on its own instead of losing the batch; one commit for all.
+    Blocking (orjson encoding of the OCR payload + commit): call via asyncio.to_thread."""
+    outcomes: List[Tuple[Optional[int], Optional[str]]] = []
+    with SessionLocal() as db:
+        for invoice_fields, items, ocr_result in entries:
+            try:
+                with db.begin_nested():
+                    invoice = Invoice(**invoice_fields, items_json=items, raw_ocr_data=orjson.dumps(ocr_result).decode())
+                    db.add(invoice)
+                    db.flush()  # assigns the invoice id for the activity log
+                    log_activity(
+                        db, actor="OCR", action=Actions.INVOICE_UPLOADED,
+                        target_type="invoice", target_id=invoice.id,
+                        detail=f"Uploaded {invoice.filename} — {invoice.vendor_name} #{invoice.invoice_number}"
+                    )
+                outcomes.append((invoice.id, None))
+            except Exception as db_error:
+                logger.error(f"Database save failed for {invoice_fields.get('filename')}: {db_error}")
+                outcomes.append((None, f"Database error: {db_error}"))
+        try:
+            db.commit()
+        except Exception as db_error:
+            db.rollback()
+            logger.error(f"Database commit failed for {len(entries)} invoice(s): {db_error}")
+            return [(None, f"Database error: {db_error}")] * len(entries)
+
+    logger.info(f"Invoices saved to database with IDs: {[i for i, _ in outcomes if i is not None]}")
+    return outcomes
+
+
+def persist_ocr_invoice(invoice_fields: Dict[str, Any], items: list, ocr_result: Dict[str, Any]) -> int:
+    """Save one OCR'd invoice and return its id; failures surface as HTTP 500."""
+    [(invoice_id, error)] = persist_ocr_invoices([(invoice_fields, items, ocr_result)])
+    if error:
+        raise HTTPException(status_code=500, detail=error)
+    return invoice_id
+
+
+def find_ocr_duplicate(vendor_name: str, invoice_number: str):
+    """Return (id, created_at) of an earlier non-CSV invoice with the same vendor + number, or None.
+    Opens a short-lived session; call via asyncio.to_thread from async handlers."""
+    with SessionLocal() as db:
+        return db.execute(
+            select(Invoice.id, Invoice.created_at)
+            .where(
+                Invoice.vendor_name == vendor_name,
+                Invoice.invoice_number == invoice_number,
+                Invoice.source != "csv_import",
+            )
+            .limit(1)
+        ).first()
 
-    try:
-        file_bytes = await file.read()
-        if not file_bytes:
-            raise HTTPException(status_code=400, detail="Uploaded file is empty")
 
-        result = analyze_invoice_from_bytes(file_bytes)
+async def ocr_duplicate_detail(result: Dict[str, Any]) -> Optional[str]:
+    """Message describing an earlier upload of the same invoice, or None if this one is new.
+    Duplicate detection: check vendor + invoice number against other OCR uploads only.
+    CSV imports are historical baseline data for price comparison — not workflow duplicates."""
+    ocr_vendor = (result.get("vendor_name") or "").strip()
+    ocr_inv_num = (result.get("invoice_id") or "").strip()
+    
+    if ocr_vendor and ocr_inv_num:
+        existing = await asyncio.to_thread(find_ocr_duplicate, ocr_vendor, ocr_inv_num)
+        if existing:
+            return f"Duplicate invoice detected: {ocr_vendor} #{ocr_inv_num} already exists (Invoice ID {existing.id}, uploaded {existing.created_at.strftime('%Y-%m-%d') if existing.created_at else 'unknown'})"
+    return None
 
-        # Remove raw SDK result from response (not JSON serializable)
-        result.pop("raw", None)
 
-    except AzureOCRError as e:
-        logger.error(f"OCR processing failed: {e}")
-        raise HTTPException(status_code=500, detail=f"OCR processing failed: {str(e)}")
+GST_RATE = 0.05  # federal GST; PST varies by province, so it is whatever tax remains
+
+
+def split_ocr_tax(ocr_tax: Optional[float], subtotal: Optional[float], tax_markers) -> Tuple[
+    Optional[float], Optional[float], Optional[float], Optional[str]
+]:
+    """Classify an OCR tax total by the labels on the page. Returns (gst, pst, hst, tax_notes)."""
+    if not ocr_tax or ocr_tax <= 0:
+        return None, None, None, None
+
+    tax_markers = set(tax_markers or ())
+    if "HST" in tax_markers:
+        return None, None, ocr_tax, "HST (auto-detected from OCR)"
+
+    if "GST" in tax_markers and "PST" in tax_markers:
+        # GST+PST province — estimate split from the subtotal if available
+        if subtotal and subtotal > 0:
+            gst = round(subtotal * GST_RATE, 2)
+            pst = round(ocr_tax - gst, 2)
+            if pst < 0:
+                return ocr_tax, None, None, "GST+PST (auto-detected from OCR)"
+            return gst, pst, None, "GST+PST (auto-detected from OCR)"
+        return ocr_tax, None, None, "GST+PST (auto-detected from OCR)"  # fallback: put it all in GST
+
+    if "GST" in tax_markers:
+        return ocr_tax, None, None, "GST (auto-detected from OCR)"
+
+    # Can't determine type — store as total only
+    return None, None, None, "Tax type unknown (review needed)"
 
+
+def ocr_invoice_fields(result: Dict[str, Any], filename: str) -> Tuple[Dict[str, Any], list]:
+    """Map a normalized OCR result to Invoice column values plus cleaned line items."""
     # Clean price values from OCR (they come back as "$1,533.48" strings)
     total_amount = clean_price(result.get("total"))
     subtotal = clean_price(result.get("subtotal"))
     
-    # Duplicate detection: check vendor + invoice number against other OCR uploads only.
-    # CSV imports are historical baseline data for price comparison — not workflow duplicates.
-    ocr_vendor = (result.get("vendor_name") or "").strip()
-    ocr_inv_num = (result.get("invoice_id") or "").strip()
-    
-    if ocr_vendor and ocr_inv_num:
-        dup_db = get_db_session()
-        try:
-            existing = dup_db.query(Invoice).filter(
-                Invoice.vendor_name == ocr_vendor,
-                Invoice.invoice_number == ocr_inv_num,
-                Invoice.source != "csv_import"
-            ).first()
-            if existing:
-                raise HTTPException(
-                    status_code=409,
-                    detail=f"Duplicate invoice detected: {ocr_vendor} #{ocr_inv_num} already exists (Invoice ID {existing.id}, uploaded {existing.created_at.strftime('%Y-%m-%d') if existing.created_at else 'unknown'})"
-                )
-        finally:
-            dup_db.close()
-
     # Extract tax from OCR result (azure_ocr.py returns "tax_total" from Azure's TotalTax field)
     ocr_tax = clean_price(result.get("tax_total"))
 
     # Auto-detect tax type from raw OCR text content
-    # Azure returns the full text — look for GST/HST/PST keywords to classify
-    ocr_gst = None
-    ocr_pst = None
-    ocr_hst = None
-    ocr_tax_notes = None
-    
-    if ocr_tax and ocr_tax > 0:
-        raw_text = json.dumps(result).upper()  # search all OCR output
-        
-        if "HST" in raw_text:
-            ocr_hst = ocr_tax
-            ocr_tax_notes = "HST (auto-detected from OCR)"
-        elif "GST" in raw_text and "PST" in raw_text:
-            # GST+PST province — estimate split (GST=5%, PST varies)
-            # Use subtotal to calculate if available
-            if subtotal and subtotal > 0:
-                ocr_gst = round(subtotal * 0.05, 2)
-                ocr_pst = round(ocr_tax - ocr_gst, 2)
-                if ocr_pst < 0:
-                    ocr_pst = None
-                    ocr_gst = ocr_tax
-            else:
-                ocr_gst = ocr_tax  # fallback: put it all in GST
-            ocr_tax_notes = "GST+PST (auto-detected from OCR)"
-        elif "GST" in raw_text:
-            ocr_gst = ocr_tax
-            ocr_tax_notes = "GST (auto-detected from OCR)"
-        else:
-            # Can't determine type — store as total only
-            ocr_tax_notes = "Tax type unknown (review needed)"
+    # azure_ocr scans the full page text for GST/HST/PST keywords (result["tax_markers"])
+    ocr_gst, ocr_pst, ocr_hst, ocr_tax_notes = split_ocr_tax(ocr_tax, subtotal, result.get("tax_markers"))
     
     logger.info(f"Tax auto-detect: total={ocr_tax}, gst={ocr_gst}, pst={ocr_pst}, hst={ocr_hst}, notes={ocr_tax_notes}")
 
@@ -459,76 +831,320 @@ async def upload_invoice_pdf(file: UploadFile = File(...)) -> Dict[str, Any]:
 
     logger.info(f"Cleaned prices - total: {result.get('total')!r} -> {total_amount}, subtotal: {result.get('subtotal')!r} -> {subtotal}")
 
-    # Save to database (separate from OCR try/except)
-    db = get_db_session()
+    invoice_fields = dict(
+        source="ocr",
+        filename=filename,
+        status="success",
+        vendor_name=result.get("vendor_name"),
+        invoice_date=result.get("invoice_date"),
+        invoice_number=result.get("invoice_id"),
+        total_amount=total_amount,
+        subtotal=subtotal,
+        tax_total=ocr_tax,
+        gst=ocr_gst,
+        pst=ocr_pst,
+        hst=ocr_hst,
+        tax_notes=ocr_tax_notes,
+    )
+
+    return invoice_fields, cleaned_items
+
+
+def validate_pdf_upload(file: UploadFile):
+    """Cheap checks on an upload before any of its body is read."""
+    if not file.filename:
+        raise HTTPException(status_code=400, detail="No file provided")
+
+    if not file.filename.lower().endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="Invalid file. Only PDF files are accepted.")
+
+    logger.info(f"Received invoice upload: {file.filename}")
+
+
+@app.post("/upload-invoice-pdf", dependencies=[Depends(content_length_limit(MAX_UPLOAD_BYTES))])
+async def upload_invoice_pdf(file: UploadFile = File(...)) -> Dict[str, Any]:
+    validate_pdf_upload(file)
+
+    spool, content_hash, size = await spool_upload(file)
     try:
-        invoice = Invoice(
-            source="ocr",
-            filename=file.filename,
-            status="success",
-            vendor_name=result.get("vendor_name"),
-            invoice_date=result.get("invoice_date"),
-            invoice_number=result.get("invoice_id"),
-            total_amount=total_amount,
-            subtotal=subtotal,
-            tax_total=ocr_tax,
-            gst=ocr_gst,
-            pst=ocr_pst,
-            hst=ocr_hst,
-            tax_notes=ocr_tax_notes,
-            items_json=json.dumps(cleaned_items),
-            raw_ocr_data=json.dumps(result)
+        if not size:
+            raise HTTPException(status_code=400, detail="Uploaded file is empty")
+
+        result = await analyze_invoice_from_stream_async(spool, content_hash)
+
+        # Remove raw SDK result from response (not JSON serializable)
+        result.pop("raw", None)
+
+    except AzureOCRError as e:
+        logger.error(f"OCR processing failed: {e}")
+        raise HTTPException(status_code=500, detail=f"OCR processing failed: {str(e)}")
+    finally:
+        spool.close()
+
+    detail = await ocr_duplicate_detail(result)
+    if detail:
+        raise HTTPException(status_code=409, detail=detail)
+
+    invoice_fields, cleaned_items = ocr_invoice_fields(result, file.filename)
+
+    # Saved before responding, so success means the row exists; the encoding
+    # + INSERT/commit run on a worker thread, off the event loop
+    invoice_id = await asyncio.to_thread(persist_ocr_invoice, invoice_fields, cleaned_items, result)
+
+    return {
+        "success": True,
+        "invoice_id": invoice_id,
+        "data": result,
+        "item_count": len(cleaned_items),
+        "filename": file.filename,
+    }
+
+
+# ========== BATCH UPLOAD ==========
+MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", "20"))
+
+
+@app.post("/upload-invoice-pdfs", dependencies=[Depends(content_length_limit(MAX_UPLOAD_BYTES, MAX_BATCH_FILES))])
+async def upload_invoice_pdfs(files: List[UploadFile] = File(...)) -> Dict[str, Any]:
+    """OCR a folder of invoices in one request.
+    All PDFs are spooled, then analyzed concurrently through the shared semaphore and
+    rate limiter (identical files share one Azure call). Each file gets its own result,
+    reported after its save; one bad file does not fail the batch."""
+    if not files:
+        raise HTTPException(status_code=400, detail="No files provided")
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=400, detail=f"Too many files. Maximum batch size is {MAX_BATCH_FILES}.")
+
+    logger.info(f"Received batch upload: {len(files)} files")
+
+    results: List[Optional[Dict[str, Any]]] = [None] * len(files)
+    spooled = []  # (index, spool, content_hash)
+    try:
+        for index, file in enumerate(files):
+            if not file.filename or not file.filename.lower().endswith(".pdf"):
+                results[index] = {"filename": file.filename, "success": False, "status_code": 400,
+                                  "error": "Invalid file. Only PDF files are accepted."}
+                continue
+            try:
+                spool, content_hash, size = await spool_upload(file)
+            except HTTPException as e:
+                results[index] = {"filename": file.filename, "success": False, "status_code": e.status_code, "error": e.detail}
+                continue
+            if not size:
+                spool.close()
+                results[index] = {"filename": file.filename, "success": False, "status_code": 400, "error": "Uploaded file is empty"}
+                continue
+            spooled.append((index, spool, content_hash))
+
+        ocr_results = await analyze_invoices_from_streams_async(
+            [(spool, content_hash) for _, spool, content_hash in spooled]
         )
+    finally:
+        for _, spool, _ in spooled:
+            spool.close()
+
+    batch_keys = set()  # vendor + invoice number already accepted earlier in this batch
+    to_persist = []
+    persist_indexes = []  # results slot for each to_persist entry
+    for (index, _, _), result in zip(spooled, ocr_results):
+        filename = files[index].filename
+        if isinstance(result, AzureOCRError):
+            logger.error(f"OCR processing failed for {filename}: {result}")
+            results[index] = {"filename": filename, "success": False, "status_code": 500,
+                              "error": f"OCR processing failed: {result}"}
+            continue
+
+        result.pop("raw", None)
+
+        key = ((result.get("vendor_name") or "").strip(), (result.get("invoice_id") or "").strip())
+        detail = await ocr_duplicate_detail(result)
+        if not detail and all(key) and key in batch_keys:
+            detail = f"Duplicate invoice detected: {key[0]} #{key[1]} appears more than once in this batch"
+        if detail:
+            results[index] = {"filename": filename, "success": False, "status_code": 409, "error": detail}
+            continue
+        batch_keys.add(key)
+
+        invoice_fields, cleaned_items = ocr_invoice_fields(result, filename)
+        to_persist.append((invoice_fields, cleaned_items, result))
+        persist_indexes.append(index)
+
+    accepted = 0
+    if to_persist:
+        # One transaction for the whole batch (a savepoint per invoice), on a worker thread
+        outcomes = await asyncio.to_thread(persist_ocr_invoices, to_persist)
+        for index, (_, cleaned_items, result), (invoice_id, error) in zip(persist_indexes, to_persist, outcomes):
+            filename = files[index].filename
+            if error:
+                results[index] = {"filename": filename, "success": False, "status_code": 500, "error": error}
+                continue
+            accepted += 1
+            results[index] = {"filename": filename, "success": True, "invoice_id": invoice_id,
+                              "data": result, "item_count": len(cleaned_items)}
+
+    return {
+        "success": accepted > 0,
+        "results": results,
+        "count": len(results),
+        "accepted": accepted,
+    }
+
+
+# ========== ASYNC OCR JOBS ==========
+# The upload returns 202 as soon as the PDF is spooled; OCR and the INSERT finish in a
+# background task. The invoice row itself is the job record (status pending -> success/failed).
+
+def create_pending_invoice(filename: str) -> int:
+    """Insert the placeholder row for an accepted upload and return its id (the job id).
+    stage_status="processing" keeps it out of the pre-coding queue until OCR completes."""
+    with SessionLocal() as db:
+        invoice = Invoice(source="ocr", filename=filename, status="pending", stage_status="processing")
         db.add(invoice)
+        db.flush()
+        invoice_id = invoice.id
         db.commit()
-        db.refresh(invoice)
-        
-        # Log the upload
-        log_activity(
-            db, actor="OCR", action=Actions.INVOICE_UPLOADED,
-            target_type="invoice", target_id=invoice.id,
-            detail=f"Uploaded {file.filename} — {invoice.vendor_name} #{invoice.invoice_number}"
+    return invoice_id
+
+
+def complete_ocr_invoice(invoice_id: int, invoice_fields: Dict[str, Any], items: list, ocr_result: Dict[str, Any]):
+    """Fill a pending invoice with its OCR results and release it to the pre-coding queue."""
+    with SessionLocal() as db:
+        try:
+            invoice = db.query(Invoice).filter(Invoice.id == invoice_id).first()
+            if not invoice:
+                logger.warning(f"OCR job {invoice_id}: invoice deleted before OCR finished")
+                return
+
+            for field, value in invoice_fields.items():
+                setattr(invoice, field, value)
+            invoice.items_json = items
+            invoice.raw_ocr_data = orjson.dumps(ocr_result).decode()
+            invoice.stage_status = "captured"
+            invoice.last_updated = datetime.utcnow()  # moves the /recent-invoices ETag off "pending"
+
+            log_activity(
+                db, actor="OCR", action=Actions.INVOICE_UPLOADED,
+                target_type="invoice", target_id=invoice_id,
+                detail=f"Uploaded {invoice.filename} — {invoice.vendor_name} #{invoice.invoice_number}"
+            )
+            db.commit()
+
+            logger.info(f"OCR job {invoice_id} saved")
+        except Exception as db_error:
+            db.rollback()
+            logger.error(f"OCR job {invoice_id}: database save failed: {db_error}")
+            fail_ocr_invoice(invoice_id, f"Database error: {db_error}")
+
+
+def fail_ocr_invoice(invoice_id: int, error: str):
+    with SessionLocal() as db:
+        db.query(Invoice).filter(Invoice.id == invoice_id).update(
+            {"status": "failed", "error_message": error, "stage_status": "failed", "last_updated": datetime.utcnow()},
+            synchronize_session=False,
         )
         db.commit()
-        
-        logger.info(f"Invoice saved to database with ID: {invoice.id}")
-    except Exception as db_error:
-        db.rollback()
-        logger.error(f"Database save failed: {db_error}")
-        raise HTTPException(status_code=500, detail=f"Database error: {str(db_error)}")
-    finally:
-        db.close()
 
-    # Return OUTSIDE the try/except/finally so db.close() has already run cleanly
-    return JSONResponse(
-        status_code=200,
-        content={
-            "success": True,
-            "data": result,
-            "item_count": len(cleaned_items),
-            "filename": file.filename,
-        },
-    )
+
+async def run_ocr_job(invoice_id: int, spool: tempfile.SpooledTemporaryFile, content_hash: str, filename: str):
+    """Background task: OCR the spooled PDF, then complete or fail the pending invoice."""
+    try:
+        try:
+            result = await analyze_invoice_from_stream_async(spool, content_hash)
+        finally:
+            spool.close()
+        result.pop("raw", None)
+
+        detail = await ocr_duplicate_detail(result)
+        if detail:
+            await asyncio.to_thread(fail_ocr_invoice, invoice_id, detail)
+            return
+
+        invoice_fields, cleaned_items = ocr_invoice_fields(result, filename)
+        await asyncio.to_thread(complete_ocr_invoice, invoice_id, invoice_fields, cleaned_items, result)
+    except AzureOCRError as e:
+        logger.error(f"OCR job {invoice_id} failed: {e}")
+        await asyncio.to_thread(fail_ocr_invoice, invoice_id, f"OCR processing failed: {e}")
+    except Exception as e:
+        logger.error(f"OCR job {invoice_id} crashed: {e}")
+        await asyncio.to_thread(fail_ocr_invoice, invoice_id, f"Processing error: {e}")
+
+
+@app.post("/upload-invoice-pdf/async", status_code=202, dependencies=[Depends(content_length_limit(MAX_UPLOAD_BYTES))])
+async def upload_invoice_pdf_async(background_tasks: BackgroundTasks, file: UploadFile = File(...)) -> Dict[str, Any]:
+    """Accept a PDF for OCR and return immediately; poll the status URL for the outcome."""
+    validate_pdf_upload(file)
+
+    spool, content_hash, size = await spool_upload(file)
+    try:
+        if not size:
+            raise HTTPException(status_code=400, detail="Uploaded file is empty")
+        invoice_id = await asyncio.to_thread(create_pending_invoice, file.filename)
+    except Exception:
+        spool.close()
+        raise
+
+    # The task owns the spool from here on and closes it
+    background_tasks.add_task(run_ocr_job, invoice_id, spool, content_hash, file.filename)
+
+    return {
+        "success": True,
+        "invoice_id": invoice_id,
+        "status": "pending",
+        "status_url": f"/api/invoices/{invoice_id}/status",
+        "filename": file.filename,
+    }
+
+
+@app.get("/api/invoices/{invoice_id}/status")
+async def get_invoice_status(invoice_id: int, db: Session = Depends(get_db)):
+    """Processing status of an uploaded invoice (pending, success or failed)."""
+    row = db.execute(
+        select(
+            Invoice.id, Invoice.status, Invoice.error_message, Invoice.filename,
+            Invoice.vendor_name, Invoice.invoice_number, Invoice.created_at,
+        ).where(Invoice.id == invoice_id)
+    ).first()
+    if not row:
+        raise HTTPException(404, "Invoice not found")
+
+    return {
+        "success": True,
+        "invoice_id": row.id,
+        "status": row.status,
+        "error_message": row.error_message,
+        "filename": row.filename,
+        "vendor_name": row.vendor_name,
+        "invoice_number": row.invoice_number,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+    }
+
+
+# True only once migrate_database has seen every child FK -> invoices reported as
+# ON DELETE CASCADE and enforced; until then delete_invoice deletes children explicitly
+FK_CASCADE_DELETES = False
 
 
 @app.delete("/api/invoices/{invoice_id}")
-async def delete_invoice(invoice_id: int):
+def delete_invoice(invoice_id: int, db: Session = Depends(get_db)):
     """Delete an invoice and its related price history and price change records"""
-    db = get_db_session()
     try:
-        invoice = db.query(Invoice).filter(Invoice.id == invoice_id).first()
+        invoice = db.execute(
+            select(Invoice.vendor_name, Invoice.invoice_number).where(Invoice.id == invoice_id)
+        ).first()
         if not invoice:
             raise HTTPException(404, "Invoice not found")
         
-        # Delete related records first (foreign key constraints)
-        db.query(PriceHistory).filter(PriceHistory.invoice_id == invoice_id).delete()
-        db.query(PriceChange).filter(
-            (PriceChange.invoice_id == invoice_id) | (PriceChange.previous_invoice_id == invoice_id)
-        ).delete(synchronize_session=False)
+        if not FK_CASCADE_DELETES:
+            # Delete related records first (foreign key constraints)
+            db.query(PriceHistory).filter(PriceHistory.invoice_id == invoice_id).delete()
+            db.query(PriceChange).filter(
+                (PriceChange.invoice_id == invoice_id) | (PriceChange.previous_invoice_id == invoice_id)
+            ).delete(synchronize_session=False)
         
         vendor = invoice.vendor_name
         inv_num = invoice.invoice_number
-        db.delete(invoice)
+        # With FK_CASCADE_DELETES the ON DELETE CASCADE FKs remove price history / price changes here
+        db.execute(delete(Invoice).where(Invoice.id == invoice_id).execution_options(synchronize_session=False))
         
         log_activity(
             db, actor="system", action=Actions.INVOICE_DELETED,
@@ -536,6 +1152,8 @@ async def delete_invoice(invoice_id: int):
             detail=f"Deleted invoice #{inv_num} from {vendor}"
         )
         db.commit()
+        if vendor:
+            invalidate_prev_invoice_cache(vendor)
         
         response = {
             "success": True,
@@ -547,51 +1165,99 @@ async def delete_invoice(invoice_id: int):
         db.rollback()
         logger.error(f"Delete failed: {e}")
         raise HTTPException(500, f"Delete failed: {str(e)}")
-    finally:
-        db.close()
     
     return response
 
 
-@app.get("/recent-invoices")
-async def get_recent_invoices(limit: int = 100):
-    """Fetch recent invoice uploads from database"""
-    db = get_db_session()
-    try:
-        invoices = db.query(Invoice).order_by(Invoice.created_at.desc()).limit(limit).all()
-        
-        result = []
-        for inv in invoices:
-            result.append({
-                "id": inv.id,
-                "created_at": inv.created_at.isoformat() if inv.created_at else None,
-                "status": inv.status,
-                "error_message": inv.error_message,
-                "source": inv.source,
-                "filename": inv.filename,
-                "vendor_name": inv.vendor_name,
-                "invoice_date": inv.invoice_date,
-                "invoice_number": inv.invoice_number,
-                "total_amount": inv.total_amount,
-                "subtotal": inv.subtotal,
-                "tax": inv.tax_total,
-                "items": json.loads(inv.items_json) if inv.items_json else [],
-            })
-    except Exception as e:
-        logger.error(f"Failed to fetch invoices: {e}")
-        raise HTTPException(status_code=500, detail="Failed to fetch invoices")
-    finally:
-        db.close()
+# Only the columns /recent-invoices ships (skips raw_ocr_data and workflow fields)
+RECENT_INVOICE_COLUMNS = (
+    Invoice.id,
+    Invoice.created_at,
+    Invoice.status,
+    Invoice.error_message,
+    Invoice.source,
+    Invoice.filename,
+    Invoice.vendor_name,
+    Invoice.invoice_date,
+    Invoice.invoice_number,
+    Invoice.total_amount,
+    Invoice.subtotal,
+    Invoice.tax_total,
+    Invoice.items_json,
+)
+
+
+RECENT_INVOICES_BATCH = 50  # rows fetched from the cursor (and written to the socket) per chunk
+RECENT_INVOICES_MAX_LIMIT = 500
+
+
+def _recent_invoice_dict(row) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+        "status": row.status,
+        "error_message": row.error_message,
+        "source": row.source,
+        "filename": row.filename,
+        "vendor_name": row.vendor_name,
+        "invoice_date": row.invoice_date,
+        "invoice_number": row.invoice_number,
+        "total_amount": row.total_amount,
+        "subtotal": row.subtotal,
+        "tax": row.tax_total,
+        "items": row.items_json or [],
+    }
+
+
+def _stream_recent_invoices(limit: int):
+    """Yield the /recent-invoices JSON body one batch of rows at a time.
+    Opens its own session: the generator runs while the response is being sent."""
+    with SessionLocal() as db:
+        # Column projection: plain Row tuples, no ORM identity map / instrumentation
+        result = db.execute(
+            select(*RECENT_INVOICE_COLUMNS)
+            .order_by(Invoice.created_at.desc())
+            .limit(limit)
+            .execution_options(yield_per=RECENT_INVOICES_BATCH)
+        )
+        yield b'{"success":true,"invoices":['
+        count = 0
+        for batch in result.partitions():
+            chunk = b",".join(orjson.dumps(_recent_invoice_dict(row)) for row in batch)
+            yield (b"," + chunk) if count else chunk
+            count += len(batch)
+        yield b'],"count":' + str(count).encode() + b"}"
+
+
+def recent_invoices_etag(limit: int) -> str:
+    """Weak ETag for /recent-invoices: changes whenever an invoice is inserted, deleted
+    or updated (every write path stamps last_updated). One aggregate query, far cheaper
+    than building the full body."""
+    with SessionLocal() as db:
+        max_id, count, max_updated = db.execute(
+            select(func.max(Invoice.id), func.count(Invoice.id), func.max(Invoice.last_updated))
+        ).one()
+    updated = max_updated.strftime("%Y%m%d%H%M%S%f") if max_updated else "0"
+    return f'W/"{max_id or 0}-{count}-{updated}-{limit}"'
 
-    return JSONResponse(
-        status_code=200,
-        content={"success": True, "count": len(result), "invoices": result}
+
+@app.get("/recent-invoices")
+async def get_recent_invoices(request: Request, limit: int = 100):
+    """Fetch recent invoice uploads from database.
+    Streamed: memory stays flat in `limit` and the first rows ship before the last are read.
+    Polling clients that send If-None-Match get a bodyless 304 until the data changes."""
+    limit = max(1, min(limit, RECENT_INVOICES_MAX_LIMIT))
+    etag = await asyncio.to_thread(recent_invoices_etag, limit)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return StreamingResponse(
+        _stream_recent_invoices(limit), media_type="application/json", headers={"ETag": etag}
     )
 
 
 # ========== HELPER FUNCTION ==========
-def format_invoice(invoice):
-    """Format invoice object for API response"""
+def format_invoice_summary(invoice):
+    """Format invoice object for list views (everything except line items)"""
     return {
         "id": invoice.id,
         "created_at": invoice.created_at.isoformat() if invoice.created_at else None,
@@ -633,47 +1299,98 @@ def format_invoice(invoice):
         # Price change info
         "price_changes_detected": invoice.price_changes_detected,
         "price_change_count": invoice.price_change_count,
-        
-        "items": json.loads(invoice.items_json) if invoice.items_json else []
     }
 
 
+def format_invoice(invoice):
+    """Format invoice object for API response"""
+    formatted = format_invoice_summary(invoice)
+    formatted["items"] = invoice.items_json or []
+    return formatted
+
+
+QUEUE_BATCH = 100  # invoices hydrated per cursor batch
+
+
+def queue_statement(stmt, include_items: bool):
+    """Queue query, leaving items_json unloaded when the caller only needs summaries.
+    yield_per hydrates a batch at a time; each formatted invoice can be freed before the next batch."""
+    if not include_items:
+        stmt = stmt.options(defer(Invoice.items_json))
+    return stmt.execution_options(yield_per=QUEUE_BATCH)
+
+
+def format_queue(invoices, include_items: bool) -> list:
+    formatter = format_invoice if include_items else format_invoice_summary
+    return [formatter(inv) for inv in invoices]
+
+
+# ========== QUEUE FILTERS ==========
+# Shared by the queue endpoints and the dashboard counts so they can't drift apart.
+
+def precoding_queue_filter():
+    """Newly captured invoices (stage 1) plus rejected ones sent back for re-coding (stage 2)."""
+    return (
+        (Invoice.current_stage == 1) & (Invoice.stage_status == "captured")
+    ) | (
+        (Invoice.current_stage == 2) & (Invoice.stage_status == "precoding")
+    )
+
+
+def dept_queue_filter(reviewer_name: str) -> tuple:
+    """Invoices pending a specific manager's department review."""
+    return (
+        Invoice.current_stage == 3,
+        Invoice.stage_status == "dept_review",
+        Invoice.dept_reviewer == reviewer_name,
+        Invoice.dept_status == "pending",
+    )
+
+
+# Queue statements built once at import; per-request work is binding parameters,
+# and the engine's compiled cache (query_cache_size) skips SQL compilation
+PRECODING_QUEUE_STMT = (
+    select(Invoice)
+    .where(precoding_queue_filter())
+    .order_by(Invoice.created_at.desc())
+)
+DEPT_QUEUE_STMT = (
+    select(Invoice)
+    .where(*dept_queue_filter(bindparam("reviewer_name")))
+    .order_by(Invoice.dept_assigned_date.desc())
+)
+PENDING_PRICE_CHANGES_STMT = (
+    select(PriceChange)
+    .where(PriceChange.review_status == "pending")
+    .order_by(PriceChange.vendor_name, PriceChange.created_at.desc())
+)
+
+
 # ========== STAGE 2: PRE-CODING ENDPOINTS ==========
 
 @app.get("/api/invoices/precoding-queue")
-async def get_precoding_queue():
+async def get_precoding_queue(include_items: bool = True, db: Session = Depends(get_db)):
     """Get all invoices waiting for pre-coding.
     Includes both newly captured invoices (stage 1) and
-    rejected invoices sent back for re-coding (stage 2)."""
-    db = get_db_session()
-    try:
-        invoices = db.query(Invoice).filter(
-            (
-                (Invoice.current_stage == 1) & (Invoice.stage_status == "captured")
-            ) | (
-                (Invoice.current_stage == 2) & (Invoice.stage_status == "precoding")
-            )
-        ).order_by(Invoice.created_at.desc()).all()
-        
-        response = {
-            "success": True,
-            "count": len(invoices),
-            "invoices": [format_invoice(inv) for inv in invoices]
-        }
-    finally:
-        db.close()
+    rejected invoices sent back for re-coding (stage 2).
+    include_items=false skips loading line items (list views); fetch one via /api/invoices/{id}."""
+    invoices = format_queue(db.execute(queue_statement(PRECODING_QUEUE_STMT, include_items)).scalars(), include_items)
+
+    response = {
+        "success": True,
+        "count": len(invoices),
+        "invoices": invoices
+    }
 
     return response
 
 
 @app.post("/api/invoices/{invoice_id}/precode")
-async def precode_invoice(invoice_id: int, body: PrecodeRequest):
+def precode_invoice(invoice_id: int, body: PrecodeRequest, db: Session = Depends(get_db)):
     """Complete pre-coding and move to Stage 3 (Dept Review)"""
     
-    if body.department not in DEPARTMENTS:
-        raise HTTPException(400, f"Invalid department. Must be one of: {', '.join(DEPARTMENTS)}")
+    dept_manager = resolve_department_manager(body.department)
     
-    db = get_db_session()
     try:
         invoice = db.query(Invoice).filter(Invoice.id == invoice_id).first()
         if not invoice:
@@ -699,11 +1416,12 @@ async def precode_invoice(invoice_id: int, body: PrecodeRequest):
         invoice.tax_notes = body.tax_notes
         
         # Advance to Stage 3
+        old_status = invoice.stage_status
         invoice.current_stage = 3
         invoice.stage_status = "dept_review"
         
         # Auto-assign to department manager
-        invoice.dept_reviewer = DEPARTMENT_MANAGERS[body.department]
+        invoice.dept_reviewer = dept_manager
         invoice.dept_assigned_date = datetime.utcnow()
         invoice.dept_status = "pending"
         
@@ -718,6 +1436,7 @@ async def precode_invoice(invoice_id: int, body: PrecodeRequest):
         
         db.commit()
         db.refresh(invoice)
+        release_prev_invoice(invoice.vendor_name, old_status)
         
         response = {
             "success": True,
@@ -730,8 +1449,6 @@ async def precode_invoice(invoice_id: int, body: PrecodeRequest):
         db.rollback()
         logger.error(f"Pre-coding failed: {e}")
         raise HTTPException(500, f"Pre-coding failed: {str(e)}")
-    finally:
-        db.close()
 
     return response
 
@@ -739,100 +1456,107 @@ async def precode_invoice(invoice_id: int, body: PrecodeRequest):
 # ========== STAGE 3: DEPARTMENT REVIEW ENDPOINTS ==========
 
 @app.get("/api/invoices/dept-queue/{reviewer_name}")
-async def get_dept_queue(reviewer_name: str):
+async def get_dept_queue(reviewer_name: str, include_items: bool = True, db: Session = Depends(get_db)):
     """Get invoices pending review for a specific manager"""
-    db = get_db_session()
-    try:
-        invoices = db.query(Invoice).filter(
-            Invoice.current_stage == 3,
-            Invoice.stage_status == "dept_review",
-            Invoice.dept_reviewer == reviewer_name,
-            Invoice.dept_status == "pending"
-        ).order_by(Invoice.dept_assigned_date.desc()).all()
-        
-        response = {
-            "success": True,
-            "reviewer": reviewer_name,
-            "count": len(invoices),
-            "invoices": [format_invoice(inv) for inv in invoices]
-        }
-    finally:
-        db.close()
+    invoices = format_queue(
+        db.execute(queue_statement(DEPT_QUEUE_STMT, include_items), {"reviewer_name": reviewer_name}).scalars(),
+        include_items,
+    )
+
+    response = {
+        "success": True,
+        "reviewer": reviewer_name,
+        "count": len(invoices),
+        "invoices": invoices
+    }
 
     return response
 
 
+# Declared after the fixed /api/invoices/... GET routes so they match first
+@app.get("/api/invoices/{invoice_id}")
+async def get_invoice(invoice_id: int, db: Session = Depends(get_db)):
+    """Full invoice detail, including line items"""
+    invoice = db.query(Invoice).filter(Invoice.id == invoice_id).first()
+    if not invoice:
+        raise HTTPException(404, "Invoice not found")
+
+    return {"success": True, "invoice": format_invoice(invoice)}
+
+
+def approve_invoice(db: Session, invoice_id: int, body: DeptApproveRequest) -> Dict[str, Any]:
+    """Approval transaction: price history save + change detection + stage move."""
+    invoice = db.query(Invoice).filter(Invoice.id == invoice_id).first()
+    if not invoice:
+        raise HTTPException(404, "Invoice not found")
+    
+    if invoice.dept_reviewer != body.reviewer:
+        raise HTTPException(403, "You are not assigned to review this invoice")
+    
+    # Approve the invoice
+    invoice.dept_status = "approved"
+    invoice.dept_review_date = datetime.utcnow()
+    invoice.dept_review_notes = body.notes
+    invoice.last_updated = datetime.utcnow()
+    invoice.last_updated_by = body.reviewer
+    
+    # ===== STAGE 4: PRICE TRACKING (runs automatically) =====
+    # 1. Save all line item prices to history
+    save_price_history(db, invoice)
+    
+    # 2. Detect price changes vs. previous invoice from same vendor
+    change_count = detect_price_changes(db, invoice)
+    
+    if change_count > 0:
+        # Price changes found — move to Stage 4 for GM review
+        invoice.current_stage = 4
+        invoice.stage_status = "price_review"
+        invoice.price_changes_detected = True
+        invoice.price_change_count = change_count
+        message = f"Invoice approved. {change_count} price change(s) detected — sent to GM for review."
+    else:
+        # No changes — invoice is fully complete
+        invoice.stage_status = "approved"
+        invoice.price_changes_detected = False
+        invoice.price_change_count = 0
+        message = "Invoice approved. No price changes detected."
+    
+    log_activity(
+        db, actor=body.reviewer, action=Actions.INVOICE_APPROVED,
+        target_type="invoice", target_id=invoice.id,
+        detail=f"Approved {invoice.vendor_name} #{invoice.invoice_number} (${invoice.total_amount:.2f}). {change_count} price change(s)."
+    )
+    
+    db.commit()
+    db.refresh(invoice)
+    remember_approved_prices(invoice)
+    
+    return {
+        "success": True,
+        "message": message,
+        "price_changes_found": change_count,
+        "invoice": format_invoice(invoice)
+    }
+
+
 @app.post("/api/invoices/{invoice_id}/dept-approve")
-async def dept_approve_invoice(invoice_id: int, body: DeptApproveRequest):
+def dept_approve_invoice(invoice_id: int, body: DeptApproveRequest, db: Session = Depends(get_db)):
     """Department manager approves invoice — triggers price history save + change detection"""
-    db = get_db_session()
     try:
-        invoice = db.query(Invoice).filter(Invoice.id == invoice_id).first()
-        if not invoice:
-            raise HTTPException(404, "Invoice not found")
-        
-        if invoice.dept_reviewer != body.reviewer:
-            raise HTTPException(403, "You are not assigned to review this invoice")
-        
-        # Approve the invoice
-        invoice.dept_status = "approved"
-        invoice.dept_review_date = datetime.utcnow()
-        invoice.dept_review_notes = body.notes
-        invoice.last_updated = datetime.utcnow()
-        invoice.last_updated_by = body.reviewer
-        
-        # ===== STAGE 4: PRICE TRACKING (runs automatically) =====
-        # 1. Save all line item prices to history
-        save_price_history(db, invoice)
-        
-        # 2. Detect price changes vs. previous invoice from same vendor
-        change_count = detect_price_changes(db, invoice)
-        
-        if change_count > 0:
-            # Price changes found — move to Stage 4 for GM review
-            invoice.current_stage = 4
-            invoice.stage_status = "price_review"
-            invoice.price_changes_detected = True
-            invoice.price_change_count = change_count
-            message = f"Invoice approved. {change_count} price change(s) detected — sent to GM for review."
-        else:
-            # No changes — invoice is fully complete
-            invoice.stage_status = "approved"
-            invoice.price_changes_detected = False
-            invoice.price_change_count = 0
-            message = "Invoice approved. No price changes detected."
-        
-        log_activity(
-            db, actor=body.reviewer, action=Actions.INVOICE_APPROVED,
-            target_type="invoice", target_id=invoice.id,
-            detail=f"Approved {invoice.vendor_name} #{invoice.invoice_number} (${invoice.total_amount:.2f}). {change_count} price change(s)."
-        )
-        
-        db.commit()
-        db.refresh(invoice)
-        
-        response = {
-            "success": True,
-            "message": message,
-            "price_changes_found": change_count,
-            "invoice": format_invoice(invoice)
-        }
+        response = approve_invoice(db, invoice_id, body)
     except HTTPException:
         raise
     except Exception as e:
         db.rollback()
         logger.error(f"Approval failed: {e}")
         raise HTTPException(500, f"Approval failed: {str(e)}")
-    finally:
-        db.close()
 
     return response
 
 
 @app.post("/api/invoices/{invoice_id}/dept-reject")
-async def dept_reject_invoice(invoice_id: int, body: DeptRejectRequest):
+def dept_reject_invoice(invoice_id: int, body: DeptRejectRequest, db: Session = Depends(get_db)):
     """Department manager rejects invoice - sends back to pre-coding"""
-    db = get_db_session()
     try:
         invoice = db.query(Invoice).filter(Invoice.id == invoice_id).first()
         if not invoice:
@@ -842,6 +1566,7 @@ async def dept_reject_invoice(invoice_id: int, body: DeptRejectRequest):
             raise HTTPException(403, "You are not assigned to review this invoice")
         
         # Reject and send back to Stage 2
+        old_status = invoice.stage_status
         invoice.dept_status = "rejected"
         invoice.dept_review_date = datetime.utcnow()
         invoice.dept_review_notes = body.notes
@@ -858,6 +1583,7 @@ async def dept_reject_invoice(invoice_id: int, body: DeptRejectRequest):
         
         db.commit()
         db.refresh(invoice)
+        release_prev_invoice(invoice.vendor_name, old_status)
         
         response = {
             "success": True,
@@ -870,8 +1596,6 @@ async def dept_reject_invoice(invoice_id: int, body: DeptRejectRequest):
         db.rollback()
         logger.error(f"Rejection failed: {e}")
         raise HTTPException(500, f"Rejection failed: {str(e)}")
-    finally:
-        db.close()
 
     return response
 
@@ -879,61 +1603,54 @@ async def dept_reject_invoice(invoice_id: int, body: DeptRejectRequest):
 # ========== STAGE 4: PRICE CHANGE REVIEW ENDPOINTS ==========
 
 @app.get("/api/price-changes/pending")
-async def get_pending_price_changes():
+async def get_pending_price_changes(db: Session = Depends(get_db)):
     """Get all pending price changes for GM review, grouped by vendor"""
-    db = get_db_session()
-    try:
-        changes = db.query(PriceChange).filter(
-            PriceChange.review_status == "pending"
-        ).order_by(PriceChange.vendor_name, PriceChange.created_at.desc()).all()
-        
-        # Group by vendor
-        vendors = {}
-        for pc in changes:
-            if pc.vendor_name not in vendors:
-                vendors[pc.vendor_name] = {
-                    "vendor_name": pc.vendor_name,
-                    "department": pc.department,
-                    "change_count": 0,
-                    "total_impact": 0.0,
-                    "changes": []
-                }
-            vendors[pc.vendor_name]["change_count"] += 1
-            vendors[pc.vendor_name]["total_impact"] += pc.price_difference
-            vendors[pc.vendor_name]["changes"].append({
-                "id": pc.id,
-                "item_description": pc.item_description,
-                "item_sku": pc.item_sku,
-                "previous_price": pc.previous_price,
-                "new_price": pc.new_price,
-                "price_difference": pc.price_difference,
-                "percent_change": pc.percent_change,
-                "previous_invoice_date": pc.previous_invoice_date,
-                "new_invoice_date": pc.new_invoice_date,
-                "invoice_id": pc.invoice_id,
-                "previous_invoice_id": pc.previous_invoice_id,
-                "review_status": pc.review_status,
-            })
-        
-        response = {
-            "success": True,
-            "vendor_count": len(vendors),
-            "total_changes": len(changes),
-            "vendors": list(vendors.values())
-        }
-    finally:
-        db.close()
+    changes = db.execute(PENDING_PRICE_CHANGES_STMT).scalars().all()
+
+    # Group by vendor
+    vendors = {}
+    for pc in changes:
+        if pc.vendor_name not in vendors:
+            vendors[pc.vendor_name] = {
+                "vendor_name": pc.vendor_name,
+                "department": pc.department,
+                "change_count": 0,
+                "total_impact": 0.0,
+                "changes": []
+            }
+        vendors[pc.vendor_name]["change_count"] += 1
+        vendors[pc.vendor_name]["total_impact"] += pc.price_difference
+        vendors[pc.vendor_name]["changes"].append({
+            "id": pc.id,
+            "item_description": pc.item_description,
+            "item_sku": pc.item_sku,
+            "previous_price": pc.previous_price,
+            "new_price": pc.new_price,
+            "price_difference": pc.price_difference,
+            "percent_change": pc.percent_change,
+            "previous_invoice_date": pc.previous_invoice_date,
+            "new_invoice_date": pc.new_invoice_date,
+            "invoice_id": pc.invoice_id,
+            "previous_invoice_id": pc.previous_invoice_id,
+            "review_status": pc.review_status,
+        })
+
+    response = {
+        "success": True,
+        "vendor_count": len(vendors),
+        "total_changes": len(changes),
+        "vendors": list(vendors.values())
+    }
 
     return response
 
 
 @app.post("/api/price-changes/{change_id}/review")
-async def review_price_change(change_id: int, body: PriceChangeReviewRequest):
+def review_price_change(change_id: int, body: PriceChangeReviewRequest, db: Session = Depends(get_db)):
     """GM acknowledges or escalates a single price change"""
     if body.review_status not in ("acknowledged", "escalated"):
         raise HTTPException(400, "review_status must be 'acknowledged' or 'escalated'")
     
-    db = get_db_session()
     try:
         pc = db.query(PriceChange).filter(PriceChange.id == change_id).first()
         if not pc:
@@ -951,27 +1668,33 @@ async def review_price_change(change_id: int, body: PriceChangeReviewRequest):
             detail=f"{body.review_status.title()} price change: {pc.vendor_name} / {pc.item_description} (${pc.previous_price:.2f} -> ${pc.new_price:.2f})"
         )
         
-        # Check if all changes for this invoice are now reviewed
-        remaining = db.query(PriceChange).filter(
-            PriceChange.invoice_id == pc.invoice_id,
-            PriceChange.review_status == "pending"
-        ).count()
+        db.flush()  # this review must be visible to the NOT EXISTS below
+        
+        # If this was the last pending change, mark invoice as complete.
+        # One conditional UPDATE: atomic even with several GMs reviewing the same invoice at once.
+        completed = db.execute(
+            update(Invoice)
+            .where(
+                Invoice.id == pc.invoice_id,
+                ~exists().where(
+                    PriceChange.invoice_id == pc.invoice_id,
+                    PriceChange.review_status == "pending",
+                ),
+            )
+            .values(stage_status="complete", last_updated=datetime.utcnow(), last_updated_by=body.reviewed_by)
+            .execution_options(synchronize_session=False)
+        ).rowcount
         
-        # If this was the last pending change, mark invoice as complete
-        if remaining == 0:
-            invoice = db.query(Invoice).filter(Invoice.id == pc.invoice_id).first()
-            if invoice:
-                invoice.stage_status = "complete"
-                invoice.last_updated = datetime.utcnow()
-                invoice.last_updated_by = body.reviewed_by
-                logger.info(f"All price changes reviewed for invoice {invoice.id} — marked complete")
+        if completed:
+            logger.info(f"All price changes reviewed for invoice {pc.invoice_id} — marked complete")
         
         db.commit()
         
+        # Completion comes from the UPDATE's rowcount; no second COUNT of the pending changes
         response = {
             "success": True,
             "message": f"Price change {body.review_status}",
-            "remaining_pending": remaining
+            "invoice_complete": bool(completed)
         }
     except HTTPException:
         raise
@@ -979,19 +1702,16 @@ async def review_price_change(change_id: int, body: PriceChangeReviewRequest):
         db.rollback()
         logger.error(f"Price change review failed: {e}")
         raise HTTPException(500, f"Review failed: {str(e)}")
-    finally:
-        db.close()
 
     return response
 
 
 @app.post("/api/price-changes/review-bulk")
-async def review_price_changes_bulk(invoice_id: int, body: PriceChangeReviewRequest):
+def review_price_changes_bulk(invoice_id: int, body: PriceChangeReviewRequest, db: Session = Depends(get_db)):
     """GM acknowledges or escalates ALL pending price changes for an invoice at once"""
     if body.review_status not in ("acknowledged", "escalated"):
         raise HTTPException(400, "review_status must be 'acknowledged' or 'escalated'")
     
-    db = get_db_session()
     try:
         changes = db.query(PriceChange).filter(
             PriceChange.invoice_id == invoice_id,
@@ -1033,50 +1753,70 @@ async def review_price_changes_bulk(invoice_id: int, body: PriceChangeReviewRequ
         db.rollback()
         logger.error(f"Bulk review failed: {e}")
         raise HTTPException(500, f"Bulk review failed: {str(e)}")
-    finally:
-        db.close()
 
     return response
 
 
+PRICE_CHANGE_HISTORY_MAX_LIMIT = 500
+
+# Plain column rows, newest review first; id breaks ties between equal reviewed_at
+PRICE_CHANGE_HISTORY_STMT = (
+    select(
+        PriceChange.id,
+        PriceChange.vendor_name,
+        PriceChange.item_description,
+        PriceChange.previous_price,
+        PriceChange.new_price,
+        PriceChange.price_difference,
+        PriceChange.percent_change,
+        PriceChange.review_status,
+        PriceChange.reviewed_by,
+        PriceChange.reviewed_at,
+        PriceChange.review_notes,
+        PriceChange.new_invoice_date,
+        PriceChange.previous_invoice_date,
+    )
+    .where(PriceChange.review_status != "pending")
+    .order_by(PriceChange.reviewed_at.desc(), PriceChange.id.desc())
+)
+
+
 @app.get("/api/price-changes/history")
-async def get_price_change_history(vendor_name: Optional[str] = None, limit: int = 50):
-    """View reviewed price changes (history). Optionally filter by vendor."""
-    db = get_db_session()
-    try:
-        query = db.query(PriceChange).filter(
-            PriceChange.review_status != "pending"
-        )
-        if vendor_name:
-            query = query.filter(PriceChange.vendor_name == vendor_name)
-        
-        changes = query.order_by(PriceChange.reviewed_at.desc()).limit(limit).all()
-        
-        result = []
-        for pc in changes:
-            result.append({
-                "id": pc.id,
-                "vendor_name": pc.vendor_name,
-                "item_description": pc.item_description,
-                "previous_price": pc.previous_price,
-                "new_price": pc.new_price,
-                "price_difference": pc.price_difference,
-                "percent_change": pc.percent_change,
-                "review_status": pc.review_status,
-                "reviewed_by": pc.reviewed_by,
-                "reviewed_at": pc.reviewed_at.isoformat() if pc.reviewed_at else None,
-                "review_notes": pc.review_notes,
-                "new_invoice_date": pc.new_invoice_date,
-                "previous_invoice_date": pc.previous_invoice_date,
-            })
-        
-        response = {
-            "success": True,
-            "count": len(result),
-            "changes": result
-        }
-    finally:
-        db.close()
+async def get_price_change_history(
+    vendor_name: Optional[str] = None,
+    limit: int = 50,
+    cursor_reviewed_at: Optional[datetime] = None,
+    cursor_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+):
+    """View reviewed price changes (history). Optionally filter by vendor.
+    Keyset pagination: pass back next_cursor's reviewed_at/id to get the following page."""
+    limit = max(1, min(limit, PRICE_CHANGE_HISTORY_MAX_LIMIT))
+    stmt = PRICE_CHANGE_HISTORY_STMT
+    if vendor_name:
+        stmt = stmt.where(PriceChange.vendor_name == vendor_name)
+    if cursor_reviewed_at is not None:
+        older = PriceChange.reviewed_at < cursor_reviewed_at
+        if cursor_id is not None:
+            older = or_(older, and_(PriceChange.reviewed_at == cursor_reviewed_at, PriceChange.id < cursor_id))
+        stmt = stmt.where(older)
+
+    result = []
+    for row in db.execute(stmt.limit(limit)).mappings():
+        entry = dict(row)
+        entry["reviewed_at"] = row["reviewed_at"].isoformat() if row["reviewed_at"] else None
+        result.append(entry)
+
+    next_cursor = None
+    if len(result) == limit and result[-1]["reviewed_at"]:
+        next_cursor = {"reviewed_at": result[-1]["reviewed_at"], "id": result[-1]["id"]}
+
+    response = {
+        "success": True,
+        "count": len(result),
+        "changes": result,
+        "next_cursor": next_cursor,
+    }
 
     return response
 
@@ -1084,131 +1824,191 @@ async def get_price_change_history(vendor_name: Optional[str] = None, limit: int
 # ========== DASHBOARD SUMMARY ENDPOINT ==========
 
 @app.get("/api/dashboard/summary")
-async def get_dashboard_summary(reviewer_name: Optional[str] = None):
+async def get_dashboard_summary(reviewer_name: Optional[str] = None, db: Session = Depends(get_db)):
     """Returns counts for the dashboard: items to code, items to approve, pending price changes."""
-    db = get_db_session()
-    try:
-        # Invoices awaiting coding (stage 1 captured OR stage 2 precoding / rejected)
-        to_code = db.query(Invoice).filter(
-            (
-                (Invoice.current_stage == 1) & (Invoice.stage_status == "captured")
-            ) | (
-                (Invoice.current_stage == 2) & (Invoice.stage_status == "precoding")
-            )
-        ).count()
-
-        # Invoices awaiting this user's approval
-        to_approve = 0
-        if reviewer_name:
-            to_approve = db.query(Invoice).filter(
-                Invoice.current_stage == 3,
-                Invoice.stage_status == "dept_review",
-                Invoice.dept_reviewer == reviewer_name,
-                Invoice.dept_status == "pending"
-            ).count()
-
-        # Pending price changes
-        pending_price_changes = db.query(PriceChange).filter(
-            PriceChange.review_status == "pending"
-        ).count()
-
-        # Total invoices
-        total_invoices = db.query(Invoice).count()
-
-        response = {
-            "success": True,
-            "to_code": to_code,
-            "to_approve": to_approve,
-            "pending_price_changes": pending_price_changes,
-            "total_invoices": total_invoices,
-        }
-    finally:
-        db.close()
+    # Invoices awaiting coding (stage 1 captured OR stage 2 precoding / rejected)
+    to_code = db.query(Invoice).filter(precoding_queue_filter()).count()
+
+    # Invoices awaiting this user's approval
+    to_approve = 0
+    if reviewer_name:
+        to_approve = db.query(Invoice).filter(*dept_queue_filter(reviewer_name)).count()
+
+    # Pending price changes
+    pending_price_changes = db.query(PriceChange).filter(
+        PriceChange.review_status == "pending"
+    ).count()
+
+    # Total invoices
+    total_invoices = db.query(Invoice).count()
+
+    response = {
+        "success": True,
+        "to_code": to_code,
+        "to_approve": to_approve,
+        "pending_price_changes": pending_price_changes,
+        "total_invoices": total_invoices,
+    }
 
     return response
 
 
 @app.get("/api/activity-log")
-async def get_activity_log(limit: int = 20):
+async def get_activity_log(limit: int = 20, db: Session = Depends(get_db)):
     """Returns recent activity log entries for the AP Processing app."""
-    db = get_db_session()
-    try:
-        entries = db.query(ActivityLog).filter(
-            ActivityLog.app_name == "ap_processing"
-        ).order_by(ActivityLog.created_at.desc()).limit(limit).all()
-
-        result = []
-        for e in entries:
-            result.append({
-                "id": e.id,
-                "created_at": e.created_at.isoformat() if e.created_at else None,
-                "actor": e.actor,
-                "action": e.action,
-                "target_type": e.target_type,
-                "target_id": e.target_id,
-                "detail": e.detail,
-            })
-
-        response = {
-            "success": True,
-            "count": len(result),
-            "entries": result,
-        }
-    finally:
-        db.close()
+    entries = db.query(ActivityLog).filter(
+        ActivityLog.app_name == "ap_processing"
+    ).order_by(ActivityLog.created_at.desc()).limit(limit).all()
+
+    result = []
+    for e in entries:
+        result.append({
+            "id": e.id,
+            "created_at": e.created_at.isoformat() if e.created_at else None,
+            "actor": e.actor,
+            "action": e.action,
+            "target_type": e.target_type,
+            "target_id": e.target_id,
+            "detail": e.detail,
+        })
+
+    response = {
+        "success": True,
+        "count": len(result),
+        "entries": result,
+    }
 
     return response
 
 
 # ========== CSV IMPORT ENDPOINT ==========
 
-@app.post("/api/import-csv")
-async def import_csv(file: UploadFile = File(...)):
-    """Import invoices from CSV file. Groups rows by invoice_number,
-    creates Invoice records with line items, and populates price_history.
-    Invoices are imported as fully approved so price history is available for comparisons."""
-    
-    if not file.filename or not file.filename.lower().endswith(".csv"):
-        raise HTTPException(400, "Only CSV files are accepted")
-    
-    content = await file.read()
-    text = content.decode("utf-8-sig")  # handle BOM if present
-    reader = csv.DictReader(io.StringIO(text))
-    
-    # Group rows by invoice_number
-    invoice_groups = {}
-    for row in reader:
-        inv_num = row.get("invoice_number", "").strip()
-        if not inv_num:
+IMPORT_BATCH_ROWS = 10_000  # rows per executemany; bounds memory on large CSVs
+IMPORT_COMMIT_INVOICES = 500  # invoices per transaction; keeps write locks short
+IMPORT_LOOKUP_CHUNK = 1000  # invoice numbers per IN (...) duplicate lookup
+
+
+def _csv_float(row: dict, key: str) -> float:
+    """Numeric CSV cell as float; blank or missing cells count as 0."""
+    value = row.get(key)
+    return float(value) if value else 0.0
+
+
+def existing_invoice_numbers(db: Session, invoice_numbers: List[str]) -> set:
+    """Return which of the given invoice numbers are already stored,
+    in one IN query per IMPORT_LOOKUP_CHUNK numbers."""
+    existing = set()
+    for start in range(0, len(invoice_numbers), IMPORT_LOOKUP_CHUNK):
+        chunk = invoice_numbers[start:start + IMPORT_LOOKUP_CHUNK]
+        existing.update(db.scalars(
+            select(Invoice.invoice_number).where(Invoice.invoice_number.in_(chunk))
+        ))
+    return existing
+
+
+def import_invoice_insert():
+    """INSERT for CSV-imported invoices that skips numbers another import already
+    stored (uq_invoice_csv_number), so concurrent imports cannot double-insert."""
+    dialect_insert = {"postgresql": pg_insert, "sqlite": sqlite_insert}.get(engine.dialect.name)
+    if dialect_insert is None:
+        return insert(Invoice)  # no upsert syntax; the prefetched duplicate check still applies
+    return dialect_insert(Invoice).on_conflict_do_nothing(
+        index_elements=[Invoice.invoice_number],
+        index_where=text("source = 'csv_import'"),  # same predicate text as the index (models.py)
+    )
+
+
+IMPORT_INVOICE_INSERT = import_invoice_insert().returning(Invoice.id, Invoice.invoice_number)
+
+
+def insert_import_batch(db: Session, invoice_rows: List[dict], invoice_items: List[list]) -> int:
+    """Insert a batch of imported invoices and their price history; returns how many
+    invoices were inserted. One multi-row INSERT ... RETURNING for the invoices supplies
+    the ids for the price history rows, which go in as one executemany per chunk.
+    Rows that lost an invoice_number conflict return nothing and get no history."""
+    invoice_ids = {
+        number: invoice_id
+        for invoice_id, number in db.execute(IMPORT_INVOICE_INSERT, invoice_rows)
+    }
+
+    ph_rows = []
+    for row, line_items in zip(invoice_rows, invoice_items):
+        invoice_id = invoice_ids.get(row["invoice_number"])
+        if invoice_id is None:
             continue
-        if inv_num not in invoice_groups:
-            invoice_groups[inv_num] = {
-                "header": row,
-                "items": []
-            }
-        invoice_groups[inv_num]["items"].append(row)
+        for item in line_items:
+            desc = item.get("description", "").strip()
+            if not desc:
+                continue
+            ph_rows.append({
+                "created_at": row["created_at"],
+                "invoice_id": invoice_id,
+                "vendor_name": row["vendor_name"],
+                "item_description": desc,
+                "item_sku": item.get("sku") or None,
+                "unit_price": item.get("unit_price"),
+                "quantity": item.get("quantity"),
+                "unit": item.get("unit") or None,
+                "line_total": item.get("line_total"),
+                "invoice_date": row["invoice_date"],
+                "department": row["department"],
+            })
+            if len(ph_rows) >= IMPORT_BATCH_ROWS:
+                db.execute(insert(PriceHistory), ph_rows)
+                ph_rows = []
+    if ph_rows:
+        db.execute(insert(PriceHistory), ph_rows)
+    return len(invoice_ids)
+
+
+def run_csv_import(db: Session, upload: BinaryIO, filename: str) -> Dict[str, Any]:
+    """Parse + import one CSV upload (binary file object). Groups rows by invoice_number,
+    creates Invoice records with line items, and populates price_history.
+    Commits every IMPORT_COMMIT_INVOICES invoices; a failure keeps earlier batches."""
+    # Parse straight off the spooled upload; no bytes + decoded str copies of the file
+    stream = io.TextIOWrapper(upload, encoding="utf-8-sig", newline="")  # handle BOM if present
+    try:
+        # Group rows by invoice_number; the first row of each group doubles as its header
+        invoice_groups = {}
+        for row in csv.DictReader(stream):
+            inv_num = row.get("invoice_number", "").strip()
+            if not inv_num:
+                continue
+            items = invoice_groups.get(inv_num)
+            if items is None:
+                items = invoice_groups[inv_num] = []
+            items.append(row)
+    except UnicodeDecodeError:
+        raise HTTPException(400, "CSV must be UTF-8 encoded")
+    finally:
+        stream.detach()  # leave the upload's file open for UploadFile to close
     
     if not invoice_groups:
         raise HTTPException(400, "No valid invoice data found in CSV")
     
-    db = get_db_session()
     created_count = 0
+    committed_count = 0  # invoices already committed by earlier batches
     skipped_count = 0
+    invoice_rows = []
+    invoice_items = []  # line items per pending invoice row, same order
     
     try:
+        existing_numbers = existing_invoice_numbers(db, list(invoice_groups))
+        
         # Sort by invoice_date so price history is chronological
         sorted_invoices = sorted(
             invoice_groups.items(),
-            key=lambda x: x[1]["header"].get("invoice_date", "")
+            key=lambda x: x[1][0].get("invoice_date", "")
         )
         
-        for inv_num, group in sorted_invoices:
-            header = group["header"]
-            items = group["items"]
+        # One timestamp for the whole import; departments repeat, so normalize each once
+        now = datetime.utcnow()
+        dept_cache = {}  # raw invoice_department -> (department, dept_reviewer)
+        
+        for inv_num, items in sorted_invoices:
+            header = items[0]
             
-            # Check if invoice already exists
-            existing = db.query(Invoice).filter(Invoice.invoice_number == inv_num).first()
-            if existing:
+            if inv_num in existing_numbers:
                 skipped_count += 1
                 continue
             
@@ -1218,37 +2018,43 @@ async def import_csv(file: UploadFile = File(...)):
                 line_items.append({
                     "description": item.get("item_description", "").strip(),
                     "sku": item.get("item_code", "").strip(),
-                    "quantity": float(item.get("quantity", 0) or 0),
+                    "quantity": _csv_float(item, "quantity"),
                     "unit": item.get("uom", "").strip(),
-                    "unit_price": float(item.get("unit_price_cad", 0) or 0),
-                    "line_total": float(item.get("line_total_cad", 0) or 0),
+                    "unit_price": _csv_float(item, "unit_price_cad"),
+                    "line_total": _csv_float(item, "line_total_cad"),
                     "tax_amount": None,
                     "date": None,
                 })
             
             # Parse tax amounts
-            gst_amt = float(header.get("gst_amount_cad", 0) or 0)
-            pst_amt = float(header.get("pst_amount_cad", 0) or 0)
-            hst_amt = float(header.get("hst_amount_cad", 0) or 0)
-            tax_total = float(header.get("total_tax_cad", 0) or 0)
+            gst_amt = _csv_float(header, "gst_amount_cad")
+            pst_amt = _csv_float(header, "pst_amount_cad")
+            hst_amt = _csv_float(header, "hst_amount_cad")
+            tax_total = _csv_float(header, "total_tax_cad")
             
             vendor_name = header.get("vendor_name", "").strip()
-            department = header.get("invoice_department", "").strip().lower()
             
-            # Determine department manager
-            dept_reviewer = DEPARTMENT_MANAGERS.get(department)
+            # Determine department + manager
+            raw_department = header.get("invoice_department", "")
+            dept = dept_cache.get(raw_department)
+            if dept is None:
+                department = raw_department.strip().lower()
+                dept = dept_cache[raw_department] = (department, DEPARTMENT_MANAGERS.get(department))
+            department, dept_reviewer = dept
             
             # Create invoice as fully approved (Stage 3 complete)
-            invoice = Invoice(
+            invoice_row = dict(
+                created_at=now,
+                last_updated=now,
                 source="csv_import",
                 filename=header.get("filename", "").strip(),
                 status="success",
                 vendor_name=vendor_name,
                 invoice_date=header.get("invoice_date", "").strip(),
                 invoice_number=inv_num,
-                total_amount=float(header.get("invoice_total_cad", 0) or 0),
-                subtotal=float(header.get("subtotal_cad", 0) or 0),
-                items_json=json.dumps(line_items),
+                total_amount=_csv_float(header, "invoice_total_cad"),
+                subtotal=_csv_float(header, "subtotal_cad"),
+                items_json=line_items,
                 
                 # Tax
                 gst=gst_amt if gst_amt > 0 else None,
@@ -1262,12 +2068,12 @@ async def import_csv(file: UploadFile = File(...)):
                 gl_account="CSV-IMPORT",
                 cost_center="CSV-IMPORT",
                 precoder="CSV Import",
-                precoding_date=datetime.utcnow(),
+                precoding_date=now,
                 
                 # Dept review (auto-approved)
                 dept_reviewer=dept_reviewer,
                 dept_status="approved",
-                dept_review_date=datetime.utcnow(),
+                dept_review_date=now,
                 dept_review_notes="Auto-approved via CSV import",
                 
                 # Stage: fully approved
@@ -1275,38 +2081,32 @@ async def import_csv(file: UploadFile = File(...)):
                 stage_status="approved",
             )
             
-            db.add(invoice)
-            db.flush()  # get the invoice.id
-            
-            # Save price history for each line item
-            for item in line_items:
-                desc = item.get("description", "").strip()
-                if not desc:
-                    continue
-                ph = PriceHistory(
-                    invoice_id=invoice.id,
-                    vendor_name=vendor_name,
-                    item_description=desc,
-                    item_sku=item.get("sku") or None,
-                    unit_price=item.get("unit_price"),
-                    quantity=item.get("quantity"),
-                    unit=item.get("unit") or None,
-                    line_total=item.get("line_total"),
-                    invoice_date=invoice.invoice_date,
-                    department=department,
-                )
-                db.add(ph)
-            
-            created_count += 1
+            invoice_rows.append(invoice_row)
+            invoice_items.append(line_items)
+            if len(invoice_rows) >= IMPORT_COMMIT_INVOICES:
+                inserted = insert_import_batch(db, invoice_rows, invoice_items)
+                db.commit()
+                db.expunge_all()
+                created_count += inserted
+                skipped_count += len(invoice_rows) - inserted  # taken by a concurrent import
+                committed_count = created_count
+                invoice_rows, invoice_items = [], []
+        
+        if invoice_rows:
+            inserted = insert_import_batch(db, invoice_rows, invoice_items)
+            created_count += inserted
+            skipped_count += len(invoice_rows) - inserted
         
         # Log the import
         log_activity(
             db, actor="CSV Import", action=Actions.CSV_IMPORTED,
             target_type="invoice", target_id=None,
-            detail=f"Imported {created_count} invoice(s), skipped {skipped_count} duplicate(s) from {file.filename}"
+            detail=f"Imported {created_count} invoice(s), skipped {skipped_count} duplicate(s) from {filename}"
         )
         
         db.commit()
+        if created_count:
+            invalidate_prev_invoice_cache()  # imported invoices may be newer baselines
         
         response = {
             "success": True,
@@ -1317,18 +2117,29 @@ async def import_csv(file: UploadFile = File(...)):
         }
     except Exception as e:
         db.rollback()
-        logger.error(f"CSV import failed: {e}")
-        raise HTTPException(500, f"CSV import failed: {str(e)}")
-    finally:
-        db.close()
+        if committed_count:
+            invalidate_prev_invoice_cache()
+        logger.error(f"CSV import failed after committing {committed_count} invoice(s): {e}")
+        raise HTTPException(500, f"CSV import failed after committing {committed_count} invoice(s): {str(e)}")
     
     return response
 
 
+@app.post("/api/import-csv")
+def import_csv(file: UploadFile = File(...), db: Session = Depends(get_db)):
+    """Import invoices from CSV file.
+    Invoices are imported as fully approved so price history is available for comparisons."""
+    
+    if not file.filename or not file.filename.lower().endswith(".csv"):
+        raise HTTPException(400, "Only CSV files are accepted")
+    
+    return run_csv_import(db, file.file, file.filename)
+
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
     logger.error("Unhandled exception", exc_info=True)
-    return JSONResponse(status_code=500, content={"success": False, "error": "Internal server error"})
+    return ORJSONResponse(status_code=500, content={"success": False, "error": "Internal server error"})
 
 
 if __name__ == "__main__":
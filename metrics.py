@@ -0,0 +1,61 @@
+# file: metrics.py
+"""
+Prometheus metrics for the upload path (spool, OCR, DB commit) and HTTP latency.
+Kept free of app/DB imports so azure_ocr.py can use it from scripts too.
+"""
+import time
+from typing import Callable
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Per-stage latency of an upload
+UPLOAD_SPOOL_SECONDS = Histogram(
+    "upload_spool_seconds", "Time to copy + hash an uploaded PDF into its spool file",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+OCR_SECONDS = Histogram(
+    "ocr_seconds", "Azure analyze call latency, per attempt",
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60),
+)
+OCR_INFLIGHT = Gauge("ocr_inflight", "Azure analyze calls in progress")
+OCR_CACHE_HITS = Counter("ocr_cache_hits_total", "OCR results served from the content-hash cache")
+DB_COMMIT_SECONDS = Histogram(
+    "db_commit_seconds", "Serialize + INSERT + commit of OCR'd invoices",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+# Request latency by route template (not raw path, to keep label cardinality bounded)
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_seconds", "HTTP request latency", ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+# Connection pool; sampled at scrape time
+DB_POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "DB connections currently checked out")
+DB_POOL_OVERFLOW = Gauge("db_pool_overflow", "DB connections open beyond pool_size")
+
+
+def register_pool_metrics(engine):
+    """Read pool gauges from `engine` on every scrape instead of polling in the background."""
+    DB_POOL_CHECKED_OUT.set_function(engine.pool.checkedout)
+    DB_POOL_OVERFLOW.set_function(lambda: max(engine.pool.overflow(), 0))
+
+
+async def track_request_latency(request, call_next: Callable):
+    """HTTP middleware: observe request latency labelled by matched route."""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.labels(
+            request.method, getattr(route, "path", "unmatched"), str(status)
+        ).observe(time.perf_counter() - start)
+
+
+def render_metrics():
+    """(body, content_type) for the /metrics endpoint."""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -1,16 +1,18 @@
 # file: models.py
-from sqlalchemy import Column, Integer, String, Float, DateTime, Text, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, DateTime, Text, Boolean, ForeignKey, Index, JSON, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import deferred
 from datetime import datetime
 from database import Base
 
 class Invoice(Base):
     __tablename__ = "invoices"
     
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Processing status
-    status = Column(String, default="success")  # success, failed, manual
+    status = Column(String, default="success")  # success, failed, manual, pending (async OCR in progress)
     error_message = Column(Text, nullable=True)
     
     # Source
@@ -33,17 +35,17 @@ class Invoice(Base):
     tax_total = Column(Float, nullable=True)
     tax_notes = Column(String, nullable=True)
     
-    # Line items stored as JSON string
-    items_json = Column(Text, nullable=True)
+    # Line items (list of dicts); JSONB on Postgres so the driver decodes it
+    items_json = Column(JSON().with_variant(JSONB, "postgresql"), nullable=True)
     
-    # Raw OCR data for reference
-    raw_ocr_data = Column(Text, nullable=True)
+    # Raw OCR data for reference; deferred: never served by the API, so not loaded with the row
+    raw_ocr_data = deferred(Column(Text, nullable=True))
     
     # ========== APPROVAL WORKFLOW ==========
     
     # Stage tracking (1-4)
     current_stage = Column(Integer, default=1)  # 1: Captured, 2: Pre-coding, 3: Dept Review, 4: Price Review
-    stage_status = Column(String, default="captured")  # captured, precoding, dept_review, price_review, approved, rejected
+    stage_status = Column(String, default="captured")  # processing, failed (async OCR), captured, precoding, dept_review, price_review, approved, rejected
     
     # Stage 2: Pre-coding
     gl_account = Column(String, nullable=True)
@@ -70,21 +72,44 @@ class Invoice(Base):
     last_updated = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     last_updated_by = Column(String, nullable=True)
 
+    __table_args__ = (
+        # /recent-invoices: ORDER BY created_at DESC LIMIT n (btree scanned backwards, no sort)
+        Index("ix_invoices_created_at", "created_at"),
+        # Pre-coding queue: current_stage + stage_status, newest first
+        Index("ix_invoice_precoding_q", "current_stage", "stage_status", "created_at"),
+        # Dept review queue: one manager's pending invoices, by assignment date
+        Index(
+            "ix_invoice_dept_q",
+            "dept_reviewer", "dept_status", "current_stage", "stage_status", "dept_assigned_date",
+        ),
+        # detect_price_changes: latest approved invoice for a vendor
+        Index("ix_invoice_vendor_recent", "vendor_name", "stage_status", "created_at"),
+        # CSV import duplicate prefetch (IN on number) and OCR duplicate check (number + vendor)
+        Index("ix_invoice_number_vendor", "invoice_number", "vendor_name"),
+        # CSV import: one row per invoice number (ON CONFLICT DO NOTHING target)
+        Index(
+            "uq_invoice_csv_number", "invoice_number",
+            unique=True,
+            postgresql_where=text("source = 'csv_import'"),
+            sqlite_where=text("source = 'csv_import'"),
+        ),
+    )
+
 
 class PriceHistory(Base):
     """Stores every line item price for historical comparison.
     Populated each time an invoice is approved (end of Stage 3)."""
     __tablename__ = "price_history"
     
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     
-    # Link to source invoice
-    invoice_id = Column(Integer, ForeignKey("invoices.id"), nullable=False)
+    # Link to source invoice (rows go with it when the invoice is deleted)
+    invoice_id = Column(Integer, ForeignKey("invoices.id", ondelete="CASCADE"), nullable=False)
     
-    # Vendor + item identification (used for matching)
-    vendor_name = Column(String, nullable=False, index=True)
-    item_description = Column(String, nullable=False, index=True)
+    # Vendor + item identification (used for matching; rows are read per invoice_id)
+    vendor_name = Column(String, nullable=False)
+    item_description = Column(String, nullable=False)
     item_sku = Column(String, nullable=True)
     
     # Pricing
@@ -97,20 +122,25 @@ class PriceHistory(Base):
     invoice_date = Column(String, nullable=True)
     department = Column(String, nullable=True)
 
+    __table_args__ = (
+        # detect_price_changes: all prices recorded for the previous invoice
+        Index("ix_price_history_invoice", "invoice_id"),
+    )
+
 
 class PriceChange(Base):
     """Flagged price differences between consecutive invoices from the same vendor.
     Created automatically after Stage 3 approval. Reviewed by GM in Stage 4."""
     __tablename__ = "price_changes"
     
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Which invoice triggered this flag
-    invoice_id = Column(Integer, ForeignKey("invoices.id"), nullable=False)
+    invoice_id = Column(Integer, ForeignKey("invoices.id", ondelete="CASCADE"), nullable=False)
     
     # The previous invoice we compared against
-    previous_invoice_id = Column(Integer, ForeignKey("invoices.id"), nullable=False)
+    previous_invoice_id = Column(Integer, ForeignKey("invoices.id", ondelete="CASCADE"), nullable=False)
     
     # Item identification
     vendor_name = Column(String, nullable=False, index=True)
@@ -134,6 +164,27 @@ class PriceChange(Base):
     reviewed_at = Column(DateTime, nullable=True)
     review_notes = Column(Text, nullable=True)
 
+    __table_args__ = (
+        # GM queue: pending changes grouped by vendor, newest first
+        Index("ix_pc_pending", "review_status", "vendor_name", "created_at"),
+        # Per-invoice lookups (incl. ON DELETE CASCADE from invoices)
+        Index("ix_pc_invoice_status", "invoice_id", "review_status"),
+        # Per-invoice review: remaining-pending check and bulk review touch only the
+        # pending subset, which stays small as changes get acknowledged
+        Index(
+            "ix_pc_invoice_pending", "invoice_id",
+            postgresql_where=text("review_status = 'pending'"),
+            sqlite_where=text("review_status = 'pending'"),
+        ),
+        # Review history: reviewed rows only, already in ORDER BY reviewed_at DESC, id DESC
+        # order, so a page is the first n index entries (no sort step, no pending rows)
+        Index(
+            "ix_pc_reviewed", reviewed_at.desc(), id.desc(),
+            postgresql_where=text("review_status <> 'pending'"),
+            sqlite_where=text("review_status <> 'pending'"),
+        ),
+    )
+
 
 class ActivityLog(Base):
     """Audit trail for all meaningful state changes across Operon Core.
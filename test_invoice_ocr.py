@@ -2,17 +2,19 @@
 Test script for Azure Document Intelligence invoice OCR.
 
 Usage:
-    python test_invoice_ocr.py path/to/invoice.pdf
+    python test_invoice_ocr.py path/to/invoice.pdf [--pretty]
+
+The result JSON is written compact; --pretty indents it for reading.
 """
 import sys
 from pathlib import Path
 from dotenv import load_dotenv
 import json
 
-from azure_ocr import analyze_invoice_from_bytes, AzureOCRError
+from azure_ocr import analyze_invoice_from_stream, AzureOCRError
 
 
-def test_invoice_ocr(pdf_path: str):
+def test_invoice_ocr(pdf_path: str, pretty: bool = False):
     """Test invoice OCR with a local PDF file."""
 
     # Load environment variables
@@ -37,10 +39,9 @@ def test_invoice_ocr(pdf_path: str):
     print("-" * 70)
 
     try:
+        # Hand the open file to the SDK; no full in-memory copy of the PDF
         with open(pdf_file, "rb") as f:
-            pdf_bytes = f.read()
-
-        result = analyze_invoice_from_bytes(pdf_bytes)
+            result = analyze_invoice_from_stream(f)
 
         print("\n✅ Analysis Complete!\n")
 
@@ -90,7 +91,10 @@ def test_invoice_ocr(pdf_path: str):
         result_copy.pop("raw", None)
 
         with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(result_copy, f, indent=2, default=str)
+            if pretty:
+                json.dump(result_copy, f, indent=2, default=str)
+            else:
+                json.dump(result_copy, f, separators=(",", ":"), default=str)
 
         print(f"\n💾 Full result saved to: {output_file}")
 
@@ -108,9 +112,10 @@ def test_invoice_ocr(pdf_path: str):
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python test_invoice_ocr.py <path_to_invoice.pdf>")
+    args = [arg for arg in sys.argv[1:] if arg != "--pretty"]
+    if not args:
+        print("Usage: python test_invoice_ocr.py <path_to_invoice.pdf> [--pretty]")
         sys.exit(1)
 
-    ok = test_invoice_ocr(sys.argv[1])
+    ok = test_invoice_ocr(args[0], pretty="--pretty" in sys.argv[1:])
     sys.exit(0 if ok else 1)
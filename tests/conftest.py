@@ -0,0 +1,29 @@
+"""Shared fixtures: the API app on a throwaway SQLite database.
+DATABASE_URL must be set before main/database are imported (the engine is built at import).
+Needs pytest + httpx (fastapi.testclient) on top of requirements.txt."""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+_DB_DIR = tempfile.mkdtemp(prefix="ap-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_DB_DIR}/test.db"
+os.environ["SKIP_DOTENV"] = "1"
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+from database import Base, engine  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    """App client with startup (schema, migrations) run; tables emptied afterwards."""
+    with TestClient(main.app) as c:
+        yield c
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    main.invalidate_prev_invoice_cache()
@@ -0,0 +1,96 @@
+import asyncio
+import io
+
+import pytest
+from azure.core.exceptions import ServiceRequestError
+
+import azure_ocr
+
+
+class FlakyPoller:
+    def __init__(self, result):
+        self._result = result
+
+    def result(self):
+        return self._result
+
+
+class FlakyClient:
+    """Fails with a transient error `failures` times, then returns the document bytes."""
+
+    def __init__(self, failures, error=ServiceRequestError("connection reset")):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def begin_analyze_document(self, model_id, document):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return FlakyPoller({"document": document.read()})
+
+
+class AsyncFlakyClient(FlakyClient):
+    async def begin_analyze_document(self, model_id, document):
+        poller = FlakyClient.begin_analyze_document(self, model_id, document)
+
+        class AsyncPoller:
+            async def result(self):
+                return poller.result()
+
+        return AsyncPoller()
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(azure_ocr, "_retry_delay", lambda exc, attempt: 0)
+    monkeypatch.setattr(azure_ocr, "_normalize_result", lambda result: result)
+    monkeypatch.setenv("AZURE_OCR_MAX_ATTEMPTS", "3")
+    azure_ocr._ocr_cache.clear()
+
+
+def analyze_sync(client, monkeypatch, content_hash=None):
+    monkeypatch.setattr(azure_ocr, "get_azure_client", lambda: client)
+    return azure_ocr.analyze_invoice_from_stream(io.BytesIO(b"%PDF"), content_hash)
+
+
+def analyze_async(client, monkeypatch, content_hash=None):
+    monkeypatch.setattr(azure_ocr, "get_async_azure_client", lambda: client)
+    return asyncio.run(azure_ocr.analyze_invoice_from_stream_async(io.BytesIO(b"%PDF"), content_hash))
+
+
+@pytest.mark.parametrize("analyze, client_cls", [(analyze_sync, FlakyClient), (analyze_async, AsyncFlakyClient)])
+def test_transient_errors_are_retried_with_the_stream_rewound(analyze, client_cls, monkeypatch):
+    client = client_cls(failures=2)
+
+    assert analyze(client, monkeypatch) == {"document": b"%PDF"}
+    assert client.calls == 3
+
+
+@pytest.mark.parametrize("analyze, client_cls", [(analyze_sync, FlakyClient), (analyze_async, AsyncFlakyClient)])
+def test_gives_up_after_max_attempts(analyze, client_cls, monkeypatch):
+    client = client_cls(failures=5)
+
+    with pytest.raises(azure_ocr.AzureOCRError):
+        analyze(client, monkeypatch)
+    assert client.calls == 3
+
+
+@pytest.mark.parametrize("analyze, client_cls", [(analyze_sync, FlakyClient), (analyze_async, AsyncFlakyClient)])
+def test_permanent_errors_are_not_retried(analyze, client_cls, monkeypatch):
+    client = client_cls(failures=1, error=ValueError("invalid document"))
+
+    with pytest.raises(azure_ocr.AzureOCRError):
+        analyze(client, monkeypatch)
+    assert client.calls == 1
+
+
+@pytest.mark.parametrize("analyze, client_cls", [(analyze_sync, FlakyClient), (analyze_async, AsyncFlakyClient)])
+def test_results_are_cached_by_content_hash(analyze, client_cls, monkeypatch):
+    client = client_cls(failures=0)
+
+    first = analyze(client, monkeypatch, content_hash="abc")
+    second = analyze(client, monkeypatch, content_hash="abc")
+
+    assert first == second
+    assert client.calls == 1
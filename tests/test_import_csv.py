@@ -0,0 +1,36 @@
+from sqlalchemy import func, select
+
+from database import SessionLocal
+from models import Invoice, PriceHistory
+
+CSV_BODY = (
+    "invoice_number,invoice_date,vendor_name,invoice_department,item_description,"
+    "quantity,unit_price_cad,line_total_cad,invoice_total_cad\n"
+    "A-1,2024-01-01,Acme Foods,kitchen,Flour 20kg,2,30.00,60.00,75.00\n"
+    "A-1,2024-01-01,Acme Foods,kitchen,Sugar 10kg,1,15.00,15.00,75.00\n"
+    "B-2,2024-02-01,Acme Foods,kitchen,Flour 20kg,1,32.50,32.50,32.50\n"
+)
+
+
+def post_csv(client, body=CSV_BODY):
+    return client.post("/api/import-csv", files={"file": ("invoices.csv", body, "text/csv")})
+
+
+def test_import_csv_inserts_invoices_and_price_history(client):
+    response = post_csv(client)
+
+    assert response.status_code == 200, response.text
+    assert response.json()["created"] == 2
+    with SessionLocal() as db:
+        assert db.scalar(select(func.count(Invoice.id))) == 2
+        assert db.scalar(select(func.count(PriceHistory.id))) == 3
+
+
+def test_import_csv_skips_invoice_numbers_already_imported(client):
+    assert post_csv(client).status_code == 200
+
+    response = post_csv(client)
+
+    assert response.status_code == 200, response.text
+    assert response.json()["created"] == 0
+    assert response.json()["skipped"] == 2
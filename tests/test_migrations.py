@@ -0,0 +1,49 @@
+import pytest
+from sqlalchemy import text
+
+import main
+from database import SessionLocal, engine
+from init_db import MigrationBlocked
+from models import Invoice, PriceChange, PriceHistory
+
+
+def test_duplicate_csv_numbers_block_unique_index_and_startup(client):
+    with engine.begin() as conn:
+        conn.execute(text('DROP INDEX "uq_invoice_csv_number"'))
+    with SessionLocal() as db:
+        db.add_all([Invoice(source="csv_import", invoice_number="A-1") for _ in range(2)])
+        db.commit()
+
+    try:
+        with pytest.raises(MigrationBlocked, match="A-1"):
+            main.migrate_database()
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text("DELETE FROM invoices"))
+        main.migrate_database()  # rebuilds the index for the remaining tests
+
+    with engine.connect() as conn:
+        names = {row[0] for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+    assert "uq_invoice_csv_number" in names
+
+
+def test_cascade_flag_follows_live_schema_and_delete_removes_children(client):
+    # SQLite runs with PRAGMA foreign_keys off, so the FKs don't cascade whatever they declare
+    assert main.FK_CASCADE_DELETES is False
+
+    with SessionLocal() as db:
+        old, new = Invoice(vendor_name="Acme"), Invoice(vendor_name="Acme")
+        db.add_all([old, new])
+        db.flush()
+        db.add(PriceHistory(invoice_id=new.id, vendor_name="Acme", item_description="Bolt"))
+        db.add(PriceChange(
+            invoice_id=new.id, previous_invoice_id=old.id, vendor_name="Acme", item_description="Bolt",
+            previous_price=1.0, new_price=1.5, price_difference=0.5, percent_change=50.0,
+        ))
+        db.commit()
+        old_id, new_id = old.id, new.id
+
+    assert client.delete(f"/api/invoices/{old_id}").status_code == 200
+    with SessionLocal() as db:
+        assert db.query(PriceChange).count() == 0
+        assert db.query(PriceHistory).filter(PriceHistory.invoice_id == new_id).count() == 1
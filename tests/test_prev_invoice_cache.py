@@ -0,0 +1,53 @@
+import main
+from database import SessionLocal
+from models import Invoice
+
+VENDOR = "Acme Foods"
+
+
+def add_approved_invoice(**fields) -> int:
+    with SessionLocal() as db:
+        invoice = Invoice(
+            source="ocr", vendor_name=VENDOR, current_stage=3, stage_status="approved",
+            dept_reviewer="Matteo Hermani", **fields,
+        )
+        db.add(invoice)
+        db.commit()
+        return invoice.id
+
+
+def cache_baseline(invoice_id: int):
+    main.cache_prev_invoice(VENDOR, main.PrevInvoice(invoice_id, "2024-01-01", None), {"flour": 30.0})
+    assert main.cached_prev_invoice(VENDOR, exclude_id=-1) is not None
+
+
+def test_dept_reject_drops_cached_baseline(client):
+    invoice_id = add_approved_invoice()
+    cache_baseline(invoice_id)
+
+    response = client.post(
+        f"/api/invoices/{invoice_id}/dept-reject", json={"reviewer": "Matteo Hermani", "notes": "wrong GL"}
+    )
+
+    assert response.status_code == 200, response.text
+    assert main.cached_prev_invoice(VENDOR, exclude_id=-1) is None
+
+
+def test_precode_of_tracked_invoice_drops_cached_baseline(client):
+    invoice_id = add_approved_invoice()
+    cache_baseline(invoice_id)
+
+    response = client.post(f"/api/invoices/{invoice_id}/precode", json={
+        "gl_account": "5000", "cost_center": "100", "department": "grocery",
+    })
+
+    assert response.status_code == 200, response.text
+    assert main.cached_prev_invoice(VENDOR, exclude_id=-1) is None
+
+
+def test_delete_drops_cached_baseline(client):
+    invoice_id = add_approved_invoice()
+    cache_baseline(invoice_id)
+
+    assert client.delete(f"/api/invoices/{invoice_id}").status_code == 200
+    assert main.cached_prev_invoice(VENDOR, exclude_id=-1) is None
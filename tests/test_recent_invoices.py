@@ -0,0 +1,62 @@
+import main
+from database import SessionLocal
+from models import Invoice
+
+
+def add_invoice(**fields) -> int:
+    with SessionLocal() as db:
+        invoice = Invoice(source="ocr", vendor_name="Acme Foods", tax_total=10.0, **fields)
+        db.add(invoice)
+        db.commit()
+        return invoice.id
+
+
+def conditional_get(client, etag):
+    return client.get("/recent-invoices", headers={"If-None-Match": etag})
+
+
+def test_unchanged_invoices_return_304(client):
+    add_invoice()
+    etag = client.get("/recent-invoices").headers["etag"]
+
+    assert conditional_get(client, etag).status_code == 304
+
+
+def test_etag_changes_when_an_invoice_is_updated(client):
+    invoice_id = add_invoice(current_stage=2, stage_status="precoding")
+    etag = client.get("/recent-invoices").headers["etag"]
+
+    response = client.post(f"/api/invoices/{invoice_id}/precode", json={
+        "gl_account": "5000", "cost_center": "100", "department": "grocery", "tax_total": 99.0,
+    })
+    assert response.status_code == 200, response.text
+
+    response = conditional_get(client, etag)
+    assert response.status_code == 200
+    assert response.json()["invoices"][0]["tax"] == 99.0
+
+
+def test_async_ocr_completion_invalidates_etag(client):
+    invoice_id = main.create_pending_invoice("scan.pdf")
+    etag = client.get("/recent-invoices").headers["etag"]
+    assert client.get("/recent-invoices").json()["invoices"][0]["status"] == "pending"
+
+    fields, items = main.ocr_invoice_fields(
+        {"vendor_name": "Acme Foods", "invoice_id": "INV-7", "total": "$10.00", "items": []}, "scan.pdf"
+    )
+    main.complete_ocr_invoice(invoice_id, fields, items, {"vendor_name": "Acme Foods"})
+
+    response = conditional_get(client, etag)
+    assert response.status_code == 200
+    assert response.json()["invoices"][0]["status"] == "success"
+
+
+def test_async_ocr_failure_invalidates_etag(client):
+    invoice_id = main.create_pending_invoice("scan.pdf")
+    etag = client.get("/recent-invoices").headers["etag"]
+
+    main.fail_ocr_invoice(invoice_id, "OCR processing failed: timeout")
+
+    response = conditional_get(client, etag)
+    assert response.status_code == 200
+    assert response.json()["invoices"][0]["status"] == "failed"
@@ -0,0 +1,100 @@
+import pytest
+
+import azure_ocr
+import main
+from database import SessionLocal
+from models import Invoice
+
+PDF = b"%PDF-1.4 test invoice"
+
+
+def ocr_result(invoice_number="INV-1"):
+    return {"vendor_name": "Acme Foods", "invoice_id": invoice_number, "total": "$10.00", "items": []}
+
+
+@pytest.fixture
+def fake_ocr(monkeypatch):
+    results = {}
+
+    async def analyze(stream, content_hash=None):
+        return dict(results.get(content_hash) or ocr_result())
+
+    async def analyze_batch(documents):
+        return [await analyze(stream, content_hash) for stream, content_hash in documents]
+
+    monkeypatch.setattr(main, "analyze_invoice_from_stream_async", analyze)
+    monkeypatch.setattr(main, "analyze_invoices_from_streams_async", analyze_batch)
+    return results
+
+
+def upload(client, content=PDF, name="invoice.pdf"):
+    return client.post("/upload-invoice-pdf", files={"file": (name, content, "application/pdf")})
+
+
+def test_upload_saves_invoice_before_responding(client, fake_ocr):
+    response = upload(client)
+
+    assert response.status_code == 200, response.text
+    invoice_id = response.json()["invoice_id"]
+    with SessionLocal() as db:
+        invoice = db.get(Invoice, invoice_id)
+        assert invoice.invoice_number == "INV-1"
+        assert invoice.status == "success"
+
+
+def test_second_upload_of_same_invoice_is_a_duplicate(client, fake_ocr):
+    assert upload(client).status_code == 200
+
+    assert upload(client).status_code == 409
+
+
+def unsaveable_result(invoice_number):
+    """OCR result whose raw payload cannot be encoded, so its INSERT fails."""
+    return {**ocr_result(invoice_number), "unencodable": {1, 2}}
+
+
+def test_failed_save_returns_500(client, fake_ocr):
+    fake_ocr[azure_ocr.document_hash(PDF)] = unsaveable_result("INV-1")
+
+    response = upload(client)
+
+    assert response.status_code == 500
+    assert "Database error" in response.json()["detail"]
+    with SessionLocal() as db:
+        assert db.query(Invoice).count() == 0
+
+
+def test_batch_reports_each_save_and_keeps_good_invoices(client, fake_ocr):
+    bad_pdf = b"%PDF-1.4 unreadable"
+    fake_ocr[azure_ocr.document_hash(PDF)] = ocr_result("INV-1")
+    fake_ocr[azure_ocr.document_hash(bad_pdf)] = unsaveable_result("INV-2")
+
+    response = client.post("/upload-invoice-pdfs", files=[
+        ("files", ("good.pdf", PDF, "application/pdf")),
+        ("files", ("bad.pdf", bad_pdf, "application/pdf")),
+    ])
+
+    assert response.status_code == 200, response.text
+    body = response.json()
+    good, bad = body["results"]
+    assert body["accepted"] == 1
+    assert good["success"] and good["invoice_id"]
+    assert not bad["success"] and bad["status_code"] == 500
+    with SessionLocal() as db:
+        assert [i.invoice_number for i in db.query(Invoice)] == ["INV-1"]
+
+
+def test_chunked_upload_without_content_length_is_accepted(client, fake_ocr):
+    boundary = "test-boundary"
+    body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="invoice.pdf"\r\n'
+        f"Content-Type: application/pdf\r\n\r\n"
+    ).encode() + PDF + f"\r\n--{boundary}--\r\n".encode()
+
+    response = client.post(
+        "/upload-invoice-pdf",
+        content=iter([body]),  # generator body -> Transfer-Encoding: chunked, no Content-Length
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+    )
+
+    assert response.status_code == 200, response.text